@@ -1,20 +1,31 @@
 from __future__ import print_function
+import checkpoint
+import collections
+import download
+import hashlib
 import imageio
+import json
+import lenet_numpy
 import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
+import profiling
+import quantize
 import sys
 import tarfile
+import threading
 from IPython.display import display, Image
 from sklearn.linear_model import LogisticRegression
-from six.moves.urllib.request import urlretrieve
 from six.moves import cPickle as pickle
 import tensorflow as tf
+from six.moves import queue
 from six.moves import range
 
 url = 'https://commondatastorage.googleapis.com/books1000/'
 last_percent_reported = None
 data_root = '/Users/rakadalal/Desktop/Deep_learning/' # Change me to store data elsewhere
+download_chunks = 4  # Ranges of an archive downloaded in parallel.
 
 num_classes = 10
 np.random.seed(133)
@@ -40,19 +51,17 @@ def download_progress_hook(count, blockSize, totalSize):
       
     last_percent_reported = percent
         
-def maybe_download(filename, expected_bytes, force=False):
-  """Download a file if not present, and make sure it's the right size."""
+def maybe_download(filename, expected_bytes, force=False, sha256=None):
+  """Download a file if not present, and make sure it's the right size (and
+  hash, if sha256 is given). Interrupted downloads are resumed."""
   dest_filename = os.path.join(data_root, filename)
-  if force or not os.path.exists(dest_filename):
+  if force or not download.verify(dest_filename, expected_bytes, sha256):
     print('Attempting to download:', filename) 
-    filename, _ = urlretrieve(url + filename, dest_filename, reporthook=download_progress_hook)
+    download.maybe_download(url + filename, dest_filename, expected_bytes, sha256,
+                            force=force, num_chunks=download_chunks,
+                            reporthook=download_progress_hook)
     print('\nDownload Complete!')
-  statinfo = os.stat(dest_filename)
-  if statinfo.st_size == expected_bytes:
-    print('Found and verified', dest_filename)
-  else:
-    raise Exception(
-      'Failed to verify ' + dest_filename + '. Can you get to it with a browser?')
+  print('Found and verified', dest_filename)
   return dest_filename
 
 def maybe_extract(filename, force=False):
@@ -76,66 +85,377 @@ def maybe_extract(filename, force=False):
   print(data_folders)
   return data_folders
 
-def load_letter(folder, min_num_images):
-  """Load the data for a single letter label."""
-  image_files = os.listdir(folder)
+def normalize(dataset):
+  """Center and scale pixels to [-0.5, 0.5]. Raw uint8 pixels are converted to
+  float32 here, float32 data is assumed to be normalized already."""
+  if dataset.dtype == np.uint8:
+    return (dataset.astype(np.float32) - pixel_depth / 2) / pixel_depth
+  return dataset
+
+def read_image(image_file, dtype=np.float32):
+  """Decode a single image file. Pixels are normalized unless dtype is
+  np.uint8, in which case they are returned raw."""
+  image_data = imageio.imread(image_file)
+  if dtype != np.uint8:
+    image_data = (image_data.astype(float) - 
+                  pixel_depth / 2) / pixel_depth
+  if image_data.shape != (image_size, image_size):
+    raise Exception('Unexpected image shape: %s' % str(image_data.shape))
+  return image_data
+
+def check_letter(dataset, min_num_images):
+  """Make sure enough images were read for a letter and report its statistics."""
+  if dataset.shape[0] < min_num_images:
+    raise Exception('Many fewer images than expected: %d < %d' %
+                    (dataset.shape[0], min_num_images))
+    
+  print('Full dataset tensor:', dataset.shape)
+  if dataset.dtype == np.uint8:
+    # Report the statistics of the normalized pixels, without normalizing.
+    print('Mean:', (np.mean(dataset) - pixel_depth / 2) / pixel_depth)
+    print('Standard deviation:', np.std(dataset) / pixel_depth)
+  else:
+    print('Mean:', np.mean(dataset))
+    print('Standard deviation:', np.std(dataset))
+
+def load_images(image_files, dtype=np.float32):
+  """Decode a list of image files, skipping the unreadable ones. Returns the
+  images that were read, and a mask of which files they came from."""
   dataset = np.ndarray(shape=(len(image_files), image_size, image_size),
-                         dtype=np.float32)
-  print(folder)
+                         dtype=dtype)
+  loaded = np.zeros(len(image_files), dtype=bool)
   num_images = 0
-  for image in image_files:
-    image_file = os.path.join(folder, image)
+  for i, image_file in enumerate(image_files):
     try:
-      image_data = (imageio.imread(image_file).astype(float) - 
-                    pixel_depth / 2) / pixel_depth
-      if image_data.shape != (image_size, image_size):
-        raise Exception('Unexpected image shape: %s' % str(image_data.shape))
-      dataset[num_images, :, :] = image_data
+      dataset[num_images, :, :] = read_image(image_file, dtype)
+      loaded[i] = True
       num_images = num_images + 1
     except (IOError, ValueError) as e:
       print('Could not read:', image_file, ':', e, '- it\'s ok, skipping.')
     
-  dataset = dataset[0:num_images, :, :]
-  if num_images < min_num_images:
-    raise Exception('Many fewer images than expected: %d < %d' %
-                    (num_images, min_num_images))
-    
-  print('Full dataset tensor:', dataset.shape)
-  print('Mean:', np.mean(dataset))
-  print('Standard deviation:', np.std(dataset))
+  return dataset[0:num_images, :, :], loaded
+
+def load_letter(folder, min_num_images, dtype=np.float32):
+  """Load the data for a single letter label."""
+  image_files = [os.path.join(folder, image) for image in os.listdir(folder)]
+  print(folder)
+  dataset, _ = load_images(image_files, dtype)
+  check_letter(dataset, min_num_images)
   return dataset
-        
-def maybe_pickle(data_folders, min_num_images_per_class, force=False):
+
+# Buffer shared by the worker processes of load_images_parallel. Each worker
+# decodes its chunk of files straight into its own rows of this buffer.
+shared_dataset = None
+
+def init_load_worker(buffer, num_rows, dtype):
+  global shared_dataset
+  shared_dataset = np.frombuffer(buffer, dtype=dtype).reshape(
+    (num_rows, image_size, image_size))
+
+def load_chunk(chunk):
+  """Decode a chunk of image files into the shared buffer, starting at row
+  `start`. Returns which of the files could be read."""
+  start, image_files = chunk
+  loaded = np.zeros(len(image_files), dtype=bool)
+  for i, image_file in enumerate(image_files):
+    try:
+      shared_dataset[start + i, :, :] = read_image(image_file, shared_dataset.dtype)
+      loaded[i] = True
+    except (IOError, ValueError) as e:
+      print('Could not read:', image_file, ':', e, '- it\'s ok, skipping.')
+  return start, loaded
+
+def load_images_parallel(file_lists, num_workers=None, chunk_size=1000,
+                         dtype=np.float32):
+  """Decode several lists of image files with a pool of processes.
+
+  Yields one (images, loaded mask) pair per list, identical to what
+  load_images would give. Each list is split into chunks of at most
+  `chunk_size` files, decoded into a buffer of its own shared with the
+  workers, so only the list being decoded and the one the caller holds are
+  in memory. The images are a view of that buffer, with the unreadable rows
+  compacted out in place.
+  """
+  num_workers = num_workers or multiprocessing.cpu_count()
+  for files in file_lists:
+    num_rows = len(files)
+    buffer = multiprocessing.RawArray(
+      np.dtype(dtype).char, max(num_rows, 1) * image_size * image_size)
+    # Small lists are cut finer, so that every worker gets some of them.
+    size = max(1, min(chunk_size, -(-num_rows // (4 * num_workers))))
+    chunks = [(i, files[i:i + size]) for i in range(0, num_rows, size)]
+    loaded = np.zeros(num_rows, dtype=bool)
+    pool = multiprocessing.Pool(num_workers, init_load_worker,
+                                (buffer, max(num_rows, 1), dtype))
+    try:
+      for start, chunk_loaded in pool.imap_unordered(load_chunk, chunks):
+        loaded[start:start + len(chunk_loaded)] = chunk_loaded
+    finally:
+      pool.close()
+      pool.join()
+
+    images = np.frombuffer(buffer, dtype=dtype).reshape(
+      (max(num_rows, 1), image_size, image_size))
+    rows = np.nonzero(loaded)[0]
+    # Move each readable row up over the unreadable ones before it. A row
+    # only moves up, so the rows still to move are never overwritten.
+    for start in range(0, len(rows), chunk_size):
+      block = rows[start:start + chunk_size]
+      if block[-1] != start + len(block) - 1:
+        images[start:start + len(block)] = images[block]
+    yield images[:len(rows)], loaded
+
+def save_dataset(set_filename, dataset):
+  """Save a class dataset, as a raw .npy block if set_filename ends in .npy
+  and as a pickle otherwise. Returns whether it could be saved."""
+  try:
+    if set_filename.endswith('.npy'):
+      np.save(set_filename, dataset)
+    else:
+      with open(set_filename, 'wb') as f:
+        pickle.dump(dataset, f, pickle.HIGHEST_PROTOCOL)
+    return True
+  except Exception as e:
+    print('Unable to save data to', set_filename, ':', e)
+    return False
+
+def load_dataset(set_filename):
+  """Open a class dataset written by save_dataset. A .npy file is memory-mapped
+  read-only, so only the rows that are sliced out of it are ever read."""
+  if set_filename.endswith('.npy'):
+    return np.load(set_filename, mmap_mode='r')
+  with open(set_filename, 'rb') as f:
+    return pickle.load(f)
+
+def folder_fingerprints(folder):
+  """Map the name of each file in a class folder to its [size, mtime]."""
+  fingerprints = {}
+  for image in os.listdir(folder):
+    stat = os.stat(os.path.join(folder, image))
+    fingerprints[image] = [stat.st_size, stat.st_mtime]
+  return fingerprints
+
+def load_manifest(set_filename):
+  """The manifest saved next to a class dataset: for each file of its folder
+  the [size, mtime, row] it had when the dataset was built, where row is -1
+  for files that could not be read. None if there is no manifest."""
+  manifest_filename = set_filename + '.manifest'
+  if not os.path.exists(manifest_filename):
+    return None
+  with open(manifest_filename) as f:
+    return json.load(f)
+
+def save_manifest(set_filename, manifest):
+  with open(set_filename + '.manifest', 'w') as f:
+    json.dump(manifest, f)
+
+def maybe_pickle(data_folders, min_num_images_per_class, force=False,
+                 num_workers=1, fmt='pickle', dtype=np.float32):
+  """Save the dataset of each class folder to folder + '.' + fmt, where fmt is
+  'pickle' or 'npy'. With num_workers other than 1, the images of all folders
+  that need saving are decoded in parallel by that many processes (None means
+  one per core). With dtype np.uint8 the raw pixels are stored, a quarter of
+  the size, and must go through normalize before use.
+
+  A manifest saved next to each dataset fingerprints the files of its folder.
+  When files are added, changed or removed, only the new and changed ones are
+  decoded and the cached dataset is patched.
+  """
   dataset_names = []
+  updates = []
   for folder in data_folders:
-    set_filename = folder + '.pickle'
+    set_filename = folder + '.' + fmt
     dataset_names.append(set_filename)
+    manifest = None
     if os.path.exists(set_filename) and not force:
-      # You may override by setting force=True.
+      manifest = load_manifest(set_filename)
+      if manifest is None:
+        # A dataset saved without a manifest can't be checked, so keep it.
+        # You may override by setting force=True.
+        print('%s already present - Skipping pickling.' % set_filename)
+        continue
+    fingerprints = folder_fingerprints(folder)
+    # Files that are unchanged since the dataset was built, and their rows.
+    kept = dict((image, entry[2]) for image, entry in (manifest or {}).items()
+                if fingerprints.get(image) == entry[:2])
+    if manifest is not None and len(kept) == len(manifest) == len(fingerprints):
       print('%s already present - Skipping pickling.' % set_filename)
-    else:
+      continue
+    new_images = sorted(image for image in fingerprints if image not in kept)
+    if manifest is None:
       print('Pickling %s.' % set_filename)
-      dataset = load_letter(folder, min_num_images_per_class)
-      try:
-        with open(set_filename, 'wb') as f:
-          pickle.dump(dataset, f, pickle.HIGHEST_PROTOCOL)
-      except Exception as e:
-        print('Unable to save data to', set_filename, ':', e)
+    else:
+      print('Updating %s: %d new or changed files, %d removed.' % (
+        set_filename, len(new_images), len(set(manifest) - set(fingerprints))))
+    updates.append((folder, set_filename, fingerprints, kept, new_images))
+
+  file_lists = [[os.path.join(folder, image) for image in new_images]
+                for folder, _, _, _, new_images in updates]
+  if num_workers != 1 and updates:
+    results = load_images_parallel(file_lists, num_workers, dtype=dtype)
+  else:
+    # Decoded as the loop below asks, so one folder is in memory at a time.
+    results = (load_images(image_files, dtype) for image_files in file_lists)
+
+  for (folder, set_filename, fingerprints, kept, new_images), (new_dataset, loaded) in zip(
+      updates, results):
+    print(folder)
+    kept_images = sorted((image for image in kept if kept[image] >= 0), key=kept.get)
+    if kept_images:
+      cached = load_dataset(set_filename)
+      if cached.dtype != dtype:
+        raise Exception('%s holds %s pixels, not %s. Rebuild it with force=True.' % (
+          set_filename, cached.dtype, np.dtype(dtype)))
+      dataset = np.concatenate(
+        [cached[[kept[image] for image in kept_images]], new_dataset])
+      del cached
+    else:
+      dataset = new_dataset
+    check_letter(dataset, min_num_images_per_class)
+    if save_dataset(set_filename, dataset):
+      manifest = dict((image, fingerprints[image] + [-1])
+                      for image in kept if kept[image] < 0)
+      read_images = kept_images + [image for image, ok in zip(new_images, loaded) if ok]
+      for row, image in enumerate(read_images):
+        manifest[image] = fingerprints[image] + [row]
+      for image, ok in zip(new_images, loaded):
+        if not ok:
+          manifest[image] = fingerprints[image] + [-1]
+      save_manifest(set_filename, manifest)
+    # Freed before the next folder is decoded.
+    del dataset, new_dataset
   
   return dataset_names
 
-def make_arrays(nb_rows, img_size):
+def decode_chunk(chunk):
+  """Decode a chunk of (member name, file contents) pairs read from a tar
+  archive. Returns the class folder name (e.g. 'A') of each image that could
+  be read, along with the images."""
+  dtype, members = chunk
+  folders = []
+  dataset = np.ndarray(shape=(len(members), image_size, image_size), dtype=dtype)
+  for name, data in members:
+    try:
+      dataset[len(folders), :, :] = read_image(data, dtype)
+      folders.append(os.path.basename(os.path.dirname(name)))
+    except (IOError, ValueError) as e:
+      print('Could not read:', name, ':', e, '- it\'s ok, skipping.')
+  return folders, dataset[0:len(folders), :, :]
+
+def read_tar_chunks(filename, chunk_size):
+  """Read the files of a .tar.gz archive in one sequential pass, yielding them
+  as lists of up to chunk_size (member name, file contents) pairs."""
+  tar = tarfile.open(filename, 'r|gz')
+  try:
+    chunk = []
+    for member in tar:
+      if not member.isfile():
+        continue
+      chunk.append((member.name, tar.extractfile(member).read()))
+      if len(chunk) == chunk_size:
+        yield chunk
+        chunk = []
+    if chunk:
+      yield chunk
+  finally:
+    tar.close()
+
+def maybe_pickle_from_tar(filename, min_num_images_per_class, force=False,
+                          num_workers=1, fmt='pickle', dtype=np.float32,
+                          chunk_size=1000):
+  """Like maybe_extract followed by maybe_pickle, but decodes the images
+  straight from the compressed archive instead of extracting them to disk.
+
+  The archive is streamed once. With num_workers other than 1, chunks of it
+  are decoded by a pool of processes while the next ones are being read. The
+  datasets are written next to the archive, in the folder it is named after.
+  """
+  root = os.path.splitext(os.path.splitext(filename)[0])[0]  # remove .tar.gz
+  if os.path.isdir(root) and not force:
+    dataset_names = sorted(
+      os.path.join(root, f) for f in os.listdir(root) if f.endswith('.' + fmt))
+    if len(dataset_names) == num_classes:
+      for set_filename in dataset_names:
+        # You may override by setting force=True.
+        print('%s already present - Skipping pickling.' % set_filename)
+      return dataset_names
+
+  print('Decoding data for %s. This may take a while. Please wait.' % root)
+  if not os.path.isdir(root):
+    os.makedirs(root)
+  dataset_names = []
+  # The archive is grouped by folder, so a class is complete, and written out,
+  # as soon as the next one starts: only one class is held in memory.
+  current = {'folder': None, 'blocks': []}
+  def save_letter():
+    folder = os.path.join(root, current['folder'])
+    print(folder)
+    dataset = np.concatenate(current['blocks'])
+    current['blocks'] = []
+    check_letter(dataset, min_num_images_per_class)
+    set_filename = folder + '.' + fmt
+    print('Pickling %s.' % set_filename)
+    save_dataset(set_filename, dataset)
+    dataset_names.append(set_filename)
+  def add_letters(result):
+    folders, dataset = result
+    start = 0
+    while start < len(folders):
+      folder = folders[start]
+      end = start + 1
+      while end < len(folders) and folders[end] == folder:
+        end += 1
+      if folder != current['folder']:
+        if current['folder'] is not None:
+          save_letter()
+        if os.path.join(root, folder) + '.' + fmt in dataset_names:
+          raise Exception('%s is not grouped by folder: %s appears twice.' % (
+            filename, folder))
+        current['folder'] = folder
+      # A copy, so that the block doesn't keep the whole chunk alive.
+      current['blocks'].append(dataset[start:end].copy())
+      start = end
+
+  if num_workers == 1:
+    for chunk in read_tar_chunks(filename, chunk_size):
+      add_letters(decode_chunk((dtype, chunk)))
+  else:
+    pool = multiprocessing.Pool(num_workers)
+    try:
+      # Keep a bounded number of chunks in flight, so that reading the archive
+      # never runs far ahead of decoding it.
+      max_pending = 2 * (num_workers or multiprocessing.cpu_count())
+      pending = collections.deque()
+      for chunk in read_tar_chunks(filename, chunk_size):
+        pending.append(pool.apply_async(decode_chunk, ((dtype, chunk),)))
+        if len(pending) >= max_pending:
+          add_letters(pending.popleft().get())
+      while pending:
+        add_letters(pending.popleft().get())
+    finally:
+      pool.close()
+      pool.join()
+  if current['folder'] is not None:
+    save_letter()
+
+  if len(dataset_names) != num_classes:
+    raise Exception(
+      'Expected %d folders, one per class. Found %d instead.' % (
+        num_classes, len(dataset_names)))
+  return sorted(dataset_names)
+
+def make_arrays(nb_rows, img_size, dtype=np.float32):
   if nb_rows:
-    dataset = np.ndarray((nb_rows, img_size, img_size), dtype=np.float32)
+    dataset = np.ndarray((nb_rows, img_size, img_size), dtype=dtype)
     labels = np.ndarray(nb_rows, dtype=np.int32)
   else:
     dataset, labels = None, None
   return dataset, labels
 
-def merge_datasets(pickle_files, train_size, valid_size=0):
+def merge_datasets(pickle_files, train_size, valid_size=0, dtype=np.float32):
   num_classes = len(pickle_files)
-  valid_dataset, valid_labels = make_arrays(valid_size, image_size)
-  train_dataset, train_labels = make_arrays(train_size, image_size)
+  valid_dataset, valid_labels = make_arrays(valid_size, image_size, dtype)
+  train_dataset, train_labels = make_arrays(train_size, image_size, dtype)
   vsize_per_class = valid_size // num_classes
   tsize_per_class = train_size // num_classes
     
@@ -144,22 +464,26 @@ def merge_datasets(pickle_files, train_size, valid_size=0):
   end_l = vsize_per_class+tsize_per_class
   for label, pickle_file in enumerate(pickle_files):       
     try:
-      with open(pickle_file, 'rb') as f:
-        letter_set = pickle.load(f)
-        # let's shuffle the letters to have random validation and training set
-        np.random.shuffle(letter_set)
-        if valid_dataset is not None:
-          valid_letter = letter_set[:vsize_per_class, :, :]
-          valid_dataset[start_v:end_v, :, :] = valid_letter
-          valid_labels[start_v:end_v] = label
-          start_v += vsize_per_class
-          end_v += vsize_per_class
-                    
-        train_letter = letter_set[vsize_per_class:end_l, :, :]
-        train_dataset[start_t:end_t, :, :] = train_letter
-        train_labels[start_t:end_t] = label
-        start_t += tsize_per_class
-        end_t += tsize_per_class
+      letter_set = load_dataset(pickle_file)
+      if letter_set.dtype != dtype:
+        raise Exception('%s holds %s pixels, not %s. Rebuild it with force=True.' % (
+          pickle_file, letter_set.dtype, np.dtype(dtype)))
+      # let's pick random letters for the validation and training set. Only the
+      # picked rows are read, and in file order, so this also works on a
+      # read-only memory map.
+      permutation = np.random.permutation(letter_set.shape[0])
+      if valid_dataset is not None:
+        valid_letter = letter_set[np.sort(permutation[:vsize_per_class]), :, :]
+        valid_dataset[start_v:end_v, :, :] = valid_letter
+        valid_labels[start_v:end_v] = label
+        start_v += vsize_per_class
+        end_v += vsize_per_class
+                  
+      train_letter = letter_set[np.sort(permutation[vsize_per_class:end_l]), :, :]
+      train_dataset[start_t:end_t, :, :] = train_letter
+      train_labels[start_t:end_t] = label
+      start_t += tsize_per_class
+      end_t += tsize_per_class
     except Exception as e:
       print('Unable to process data from', pickle_file, ':', e)
       raise
@@ -169,30 +493,245 @@ def merge_datasets(pickle_files, train_size, valid_size=0):
 train_filename = maybe_download('notMNIST_large.tar.gz', 247336696)
 test_filename = maybe_download('notMNIST_small.tar.gz', 8458043)
 
-train_folders = maybe_extract(train_filename)
-test_folders = maybe_extract(test_filename)
+ingest_workers = None  # Processes decoding images; None uses every core, 1 is serial.
 
-train_datasets = maybe_pickle(train_folders, 45000)
-test_datasets = maybe_pickle(test_folders, 1800)
+dataset_format = 'npy'  # 'npy' datasets are memory-mapped, 'pickle' ones loaded.
+pixel_dtype = np.float32  # np.uint8 stores raw pixels and normalizes each minibatch.
+extract_archives = False  # False decodes the images straight from the archives.
+
+if extract_archives:
+  train_folders = maybe_extract(train_filename)
+  test_folders = maybe_extract(test_filename)
+
+  train_datasets = maybe_pickle(train_folders, 45000, num_workers=ingest_workers,
+                                fmt=dataset_format, dtype=pixel_dtype)
+  test_datasets = maybe_pickle(test_folders, 1800, num_workers=ingest_workers,
+                               fmt=dataset_format, dtype=pixel_dtype)
+else:
+  train_datasets = maybe_pickle_from_tar(train_filename, 45000, num_workers=ingest_workers,
+                                         fmt=dataset_format, dtype=pixel_dtype)
+  test_datasets = maybe_pickle_from_tar(test_filename, 1800, num_workers=ingest_workers,
+                                        fmt=dataset_format, dtype=pixel_dtype)
 
 train_size = 200000
 valid_size = 10000
 test_size = 10000
 
-valid_dataset, valid_labels, train_dataset, train_labels = merge_datasets(
-  train_datasets, train_size, valid_size)
-_, _, test_dataset, test_labels = merge_datasets(test_datasets, test_size)
-
 def randomize(dataset, labels):
   permutation = np.random.permutation(labels.shape[0])
   shuffled_dataset = dataset[permutation,:,:]
   shuffled_labels = labels[permutation]
   return shuffled_dataset, shuffled_labels
 
+def gather_rows(source, rows, dest, positions, block_size=4096):
+  """dest[positions] = source[rows], a block of rows at a time so that the
+  temporary copy fancy indexing makes stays small."""
+  for start in range(0, len(rows), block_size):
+    dest[positions[start:start + block_size]] = source[rows[start:start + block_size]]
+
+def merge_shuffled_datasets(pickle_files, train_size, valid_size=0, dtype=np.float32):
+  """Same splits as merge_datasets followed by randomize, in a single pass.
+
+  Where every row lands in the shuffled validation and training sets is drawn
+  up front, then the rows picked from each class are gathered straight into
+  those positions. No class or split is shuffled in place or copied twice.
+  """
+  num_classes = len(pickle_files)
+  vsize_per_class = valid_size // num_classes
+  tsize_per_class = train_size // num_classes
+  valid_dataset, valid_labels = make_arrays(vsize_per_class * num_classes, image_size, dtype)
+  train_dataset, train_labels = make_arrays(tsize_per_class * num_classes, image_size, dtype)
+  valid_positions = np.random.permutation(vsize_per_class * num_classes)
+  train_positions = np.random.permutation(tsize_per_class * num_classes)
+
+  end_l = vsize_per_class + tsize_per_class
+  for label, pickle_file in enumerate(pickle_files):
+    try:
+      letter_set = load_dataset(pickle_file)
+      if letter_set.dtype != dtype:
+        raise Exception('%s holds %s pixels, not %s. Rebuild it with force=True.' % (
+          pickle_file, letter_set.dtype, np.dtype(dtype)))
+      # The picked rows are read in file order, which is what a memory map
+      # likes best; their positions in the split are already random.
+      permutation = np.random.permutation(letter_set.shape[0])
+      if valid_dataset is not None:
+        positions = valid_positions[label * vsize_per_class:(label + 1) * vsize_per_class]
+        gather_rows(letter_set, np.sort(permutation[:vsize_per_class]),
+                    valid_dataset, positions)
+        valid_labels[positions] = label
+      positions = train_positions[label * tsize_per_class:(label + 1) * tsize_per_class]
+      gather_rows(letter_set, np.sort(permutation[vsize_per_class:end_l]),
+                  train_dataset, positions)
+      train_labels[positions] = label
+    except Exception as e:
+      print('Unable to process data from', pickle_file, ':', e)
+      raise
+
+  return valid_dataset, valid_labels, train_dataset, train_labels
 
-train_dataset, train_labels = randomize(train_dataset, train_labels)
-test_dataset, test_labels = randomize(test_dataset, test_labels)
-valid_dataset, valid_labels = randomize(valid_dataset, valid_labels)
+def save_splits(store_dir, splits):
+  """Write each array of the `splits` dict as a raw .npy block in store_dir,
+  along with an index.json header listing their shapes and dtypes."""
+  if not os.path.isdir(store_dir):
+    os.makedirs(store_dir)
+  index = {}
+  for name, array in splits.items():
+    np.save(os.path.join(store_dir, name + '.npy'), array)
+    index[name] = {'shape': list(array.shape), 'dtype': str(array.dtype)}
+  # The index is written last, so a store is only complete once it exists.
+  with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+    json.dump(index, f, indent=2, sort_keys=True)
+
+def load_splits(store_dir):
+  """Memory-map the arrays written by save_splits. Nothing is read until the
+  arrays are sliced."""
+  with open(os.path.join(store_dir, 'index.json')) as f:
+    index = json.load(f)
+  return dict((name, np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r'))
+              for name in index)
+
+def exact_hashes(dataset):
+  """64-bit content hash of every image, so that byte-identical images can be
+  matched by comparing one integer."""
+  rows = np.ascontiguousarray(dataset).reshape((dataset.shape[0], -1))
+  return np.frombuffer(b''.join(hashlib.sha1(row.tobytes()).digest()[:8] for row in rows),
+                       dtype=np.uint64)
+
+def lsh_signatures(dataset, rows, planes, block_size=10000):
+  """Random-projection signatures of the given rows of dataset, one per table
+  of planes: bit k of a signature tells on which side of plane k the image
+  lies. Similar images mostly get the same signature in at least one table."""
+  num_tables, num_bits = planes.shape[0], planes.shape[2]
+  weights = (2 ** np.arange(num_bits)).astype(np.uint64)
+  signatures = np.zeros((num_tables, len(rows)), dtype=np.uint64)
+  for start in range(0, len(rows), block_size):
+    block = normalize(dataset[rows[start:start + block_size]]).reshape(
+      (-1, image_size * image_size))
+    for t in range(num_tables):
+      bits = (np.dot(block, planes[t]) > 0).astype(np.uint64)
+      signatures[t, start:start + block_size] = np.dot(bits, weights)
+  return signatures
+
+def overlap_index(dataset, num_tables=4, num_bits=16, seed=0):
+  """Content hash and LSH signatures of every image of dataset, and the first
+  row of each distinct image. Built once per split, and reused by every
+  find_overlap that the split takes part in."""
+  hashes = exact_hashes(dataset)
+  unique_hashes, unique_rows = np.unique(hashes, return_index=True)
+  planes = np.random.RandomState(seed).randn(
+    num_tables, image_size * image_size, num_bits).astype(np.float32)
+  return {'hashes': hashes, 'unique_hashes': unique_hashes,
+          'unique_rows': np.sort(unique_rows),
+          'signatures': lsh_signatures(dataset, np.arange(dataset.shape[0]), planes)}
+
+def find_overlap(dataset, reference, threshold=0.02, index=None, reference_index=None,
+                 max_pairs=20000):
+  """Find the images of dataset that have an exact or near duplicate in
+  reference. Near duplicates differ from some reference image by at most
+  `threshold` on average per (normalized) pixel.
+
+  Exact duplicates are matched by content hash. The remaining images are
+  bucketed with a random-projection LSH index over the unique reference
+  images, and only pairs that share a bucket are compared. index and
+  reference_index are the overlap_index of each, computed here when not
+  given. Returns the indices of the exact and of the near duplicates in
+  dataset.
+  """
+  index = overlap_index(dataset) if index is None else index
+  reference_index = overlap_index(reference) if reference_index is None else reference_index
+  exact = np.nonzero(np.isin(index['hashes'], reference_index['unique_hashes']))[0]
+  # Exact duplicates can't be near duplicates, and duplicates within reference
+  # only need to be compared once.
+  candidates = np.setdiff1d(np.arange(dataset.shape[0]), exact)
+  unique_rows = reference_index['unique_rows']
+  signatures = index['signatures'][:, candidates]
+  reference_signatures = reference_index['signatures'][:, unique_rows]
+
+  found = np.zeros(len(candidates), dtype=bool)
+  for t in range(len(signatures)):
+    order = np.argsort(reference_signatures[t], kind='mergesort')
+    sorted_signatures = reference_signatures[t][order]
+    lo = np.searchsorted(sorted_signatures, signatures[t], 'left')
+    counts = np.searchsorted(sorted_signatures, signatures[t], 'right') - lo
+    counts[found] = 0
+    # Compare the pairs that share a bucket, a bounded number at a time.
+    ends = np.cumsum(counts)
+    start = 0
+    while start < len(candidates):
+      stop = max(start + 1, np.searchsorted(
+        ends, ends[start] - counts[start] + max_pairs, 'right'))
+      block_counts = counts[start:stop]
+      left = np.repeat(np.arange(start, stop), block_counts)
+      offsets = np.arange(len(left)) - np.repeat(np.cumsum(block_counts) - block_counts,
+                                                 block_counts)
+      right = unique_rows[order[np.repeat(lo[start:stop], block_counts) + offsets]]
+      if len(left):
+        distances = np.mean(np.abs(
+          normalize(dataset[candidates[left]]).reshape((len(left), -1)) -
+          normalize(reference[right]).reshape((len(left), -1))), axis=1)
+        found[left[distances <= threshold]] = True
+      start = stop
+  return exact, candidates[found]
+
+def overlap_report(splits, threshold=0.02):
+  """Count the exact and near duplicates between each pair of splits, and the
+  exact duplicates within each split. splits maps a name to a dataset, and is
+  compared in order: each split against the ones before it. Every split is
+  hashed and projected once. Returns the report, and the overlaps it counts:
+  the (exact, near) indices of find_overlap for each (name, other) pair."""
+  report, overlaps = {}, {}
+  names = list(splits)
+  indices = dict((name, overlap_index(splits[name])) for name in names)
+  for i, name in enumerate(names):
+    index = indices[name]
+    report[name] = {'images': len(index['hashes']),
+                    'exact duplicates within': len(index['hashes']) - len(index['unique_rows'])}
+    for other in names[:i]:
+      exact, near = overlaps[name, other] = find_overlap(
+        splits[name], splits[other], threshold, index, indices[other])
+      report[name]['exact in ' + other] = len(exact)
+      report[name]['near in ' + other] = len(near)
+  return report, overlaps
+
+def sanitize_splits(valid_dataset, valid_labels, test_dataset, test_labels, overlaps):
+  """Drop the validation images that have an exact or near duplicate in the
+  training set, and the test images that have one in either, given the
+  overlaps of overlap_report over the train, valid and test splits."""
+  keep = np.setdiff1d(np.arange(valid_dataset.shape[0]),
+                      np.concatenate(overlaps['valid', 'train']))
+  valid_dataset, valid_labels = valid_dataset[keep], valid_labels[keep]
+  dropped = np.concatenate(overlaps['test', 'train'] + overlaps['test', 'valid'])
+  keep = np.setdiff1d(np.arange(test_dataset.shape[0]), dropped)
+  return valid_dataset, valid_labels, test_dataset[keep], test_labels[keep]
+
+splits_dir = os.path.join(data_root, 'notMNIST_splits')
+sanitize_overlap = True  # Drop validation/test images duplicated in an earlier split.
+
+if os.path.exists(os.path.join(splits_dir, 'index.json')):
+  # Delete the directory to draw new splits.
+  print('%s already present - Skipping merging.' % splits_dir)
+else:
+  valid_dataset, valid_labels, train_dataset, train_labels = merge_shuffled_datasets(
+    train_datasets, train_size, valid_size, pixel_dtype)
+  _, _, test_dataset, test_labels = merge_shuffled_datasets(test_datasets, test_size,
+                                                            dtype=pixel_dtype)
+  if sanitize_overlap:
+    splits = {'train': train_dataset, 'valid': valid_dataset, 'test': test_dataset}
+    report, overlaps = overlap_report(splits)
+    print('Overlap between splits:', json.dumps(report, indent=2))
+    valid_dataset, valid_labels, test_dataset, test_labels = sanitize_splits(
+      valid_dataset, valid_labels, test_dataset, test_labels, overlaps)
+    print('Sanitized validation set:', valid_dataset.shape)
+    print('Sanitized test set:', test_dataset.shape)
+  save_splits(splits_dir, {
+    'train_dataset': train_dataset, 'train_labels': train_labels,
+    'valid_dataset': valid_dataset, 'valid_labels': valid_labels,
+    'test_dataset': test_dataset, 'test_labels': test_labels})
+
+splits = load_splits(splits_dir)
+train_dataset, train_labels = splits['train_dataset'], splits['train_labels']
+valid_dataset, valid_labels = splits['valid_dataset'], splits['valid_labels']
+test_dataset, test_labels = splits['test_dataset'], splits['test_labels']
 
 # print('Training:', train_dataset.shape, train_labels.shape)
 # print('Validation:', valid_dataset.shape, valid_labels.shape)
@@ -213,6 +752,76 @@ valid_dataset, valid_labels = randomize(valid_dataset, valid_labels)
 # print('Validation set', valid_dataset.shape, valid_labels.shape)
 # print('Test set', test_dataset.shape, test_labels.shape)
 
+class BatchPrefetcher(object):
+  """Prepare upcoming minibatches on a background thread, so that the training
+  loop never waits on slicing, normalizing or reading them from disk.
+
+  Batch `step` is the same slice the training loops have always used, or with
+  shuffle=True, a slice of a permutation drawn for each epoch from `seed`.
+  Either way it only depends on step, so a run resumed at start_step sees the
+  same batches. At most `capacity` batches are prepared ahead.
+  """
+  def __init__(self, dataset, labels, batch_size, start_step=0, shuffle=False,
+               seed=0, capacity=32):
+    self._dataset = dataset
+    self._labels = labels
+    self._batch_size = batch_size
+    self._shuffle = shuffle
+    self._seed = seed
+    self._epoch = None
+    self._queue = queue.Queue(capacity)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._fill, args=(start_step,))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _batch(self, step):
+    """Build the batch for a given step."""
+    num_rows = self._labels.shape[0]
+    if not self._shuffle:
+      offset = (step * self._batch_size) % (num_rows - self._batch_size)
+      rows = slice(offset, offset + self._batch_size)
+    else:
+      epoch, index = divmod(step, num_rows // self._batch_size)
+      if epoch != self._epoch:
+        self._permutation = np.random.RandomState(self._seed + epoch).permutation(num_rows)
+        self._epoch = epoch
+      # Sorted rows are read in file order from a memory-mapped dataset.
+      rows = np.sort(self._permutation[index * self._batch_size:
+                                       (index + 1) * self._batch_size])
+    # np.array copies the rows out of a memory map here, not in the training loop.
+    return normalize(np.array(self._dataset[rows])), np.array(self._labels[rows])
+
+  def _put(self, item):
+    """Queue an item, giving up if the prefetcher is closed meanwhile."""
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        pass
+
+  def _fill(self, step):
+    try:
+      while not self._stop.is_set():
+        self._put(self._batch(step))
+        step += 1
+    except Exception as e:
+      # Handed to the training loop, which raises it from next().
+      self._put(e)
+
+  def next(self):
+    """Return the (batch_data, batch_labels) of the next step."""
+    batch = self._queue.get()
+    if isinstance(batch, Exception):
+      raise batch
+    return batch
+
+  def close(self):
+    """Stop the background thread."""
+    self._stop.set()
+    self._thread.join()
+
 # With gradient descent training, even this much data is prohibitive.
 # Subset the training data for faster turnaround.
 # train_subset = 10000
@@ -373,6 +982,176 @@ def accuracy(predictions, labels):
     return (100.0 * np.sum(np.argmax(predictions, 1) == np.argmax(labels, 1))
             / predictions.shape[0])
 
+def evaluate(session, prediction, tf_dataset, dataset, labels, chunk_size=1000):
+    """Accuracy of a placeholder-fed prediction over a whole dataset. The images
+    are fed chunk_size at a time, so memory use doesn't grow with the dataset."""
+    correct = 0
+    for offset in range(0, labels.shape[0], chunk_size):
+        chunk = normalize(np.array(dataset[offset:(offset + chunk_size)]))
+        predictions = session.run(prediction, feed_dict={tf_dataset: chunk})
+        correct += np.sum(np.argmax(predictions, 1) ==
+                          np.argmax(labels[offset:(offset + chunk_size)], 1))
+    return 100.0 * correct / labels.shape[0]
+
+def train_logistic(beta, num_steps, splits_dir, num_threads=1, batch_size=128):
+    """Train the L2-regularized logistic regression of the beta sweep in a
+    graph of its own, on the memory-mapped splits in splits_dir. Returns its
+    validation and test accuracy."""
+    splits = load_splits(splits_dir)
+    train_dataset = splits['train_dataset'].reshape((-1, image_size * image_size))
+    train_labels = splits['train_labels']
+    one_hot = lambda labels: (np.arange(num_classes) == labels[:, None]).astype(np.float32)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size * image_size))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_classes))
+        tf_eval_dataset = tf.placeholder(tf.float32, shape=(None, image_size * image_size))
+
+        weights = tf.Variable(tf.truncated_normal([image_size * image_size, num_classes]))
+        biases = tf.Variable(tf.zeros([num_classes]))
+
+        logits = tf.matmul(tf_train_dataset, weights) + biases
+        loss = tf.reduce_mean(
+            tf.nn.softmax_cross_entropy_with_logits(labels=tf_train_labels, logits=logits)) + beta * tf.nn.l2_loss(weights)
+        optimizer = tf.train.GradientDescentOptimizer(0.5).minimize(loss)
+        eval_prediction = tf.nn.softmax(tf.matmul(tf_eval_dataset, weights) + biases)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                            inter_op_parallelism_threads=1)
+    with tf.Session(graph=graph, config=config) as session:
+        tf.global_variables_initializer().run()
+        for step in range(num_steps):
+            offset = (step * batch_size) % (train_labels.shape[0] - batch_size)
+            batch_data = normalize(np.array(train_dataset[offset:(offset + batch_size)]))
+            batch_labels = one_hot(train_labels[offset:(offset + batch_size)])
+            session.run(optimizer, feed_dict={tf_train_dataset: batch_data,
+                                              tf_train_labels: batch_labels})
+        return [evaluate(session, eval_prediction, tf_eval_dataset,
+                         splits[name + '_dataset'].reshape((-1, image_size * image_size)),
+                         one_hot(np.array(splits[name + '_labels'])))
+                for name in ('valid', 'test')]
+
+def sweep_trial(args):
+    train_fn, beta, num_steps, splits_dir, num_threads = args
+    return train_fn(beta, num_steps, splits_dir, num_threads)
+
+def run_sweep(train_fn, beta_val, splits_dir, min_steps=300, max_steps=3001, eta=3,
+              num_workers=None, threads_per_trial=1):
+    """Run train_fn(beta, num_steps, splits_dir, num_threads) for every beta
+    on a pool of processes, with successive halving: all betas are trained for
+    min_steps, then only the best 1/eta by validation accuracy go on to a run
+    eta times longer, until max_steps. Every trial reads the same read-only
+    memory-mapped splits, so they share one copy of the data. threads_per_trial
+    caps the threads of each trial's TensorFlow session; the NumPy work of a
+    trial is elementwise and doesn't use BLAS threads.
+
+    Must run before the parent process opens any TensorFlow session, since
+    the workers are forked. Returns the best beta, its test accuracy, and
+    {beta: (num_steps, valid accuracy, test accuracy)} from the last rung each
+    beta reached.
+    """
+    results = {}
+    survivors = list(beta_val)
+    num_steps = min_steps
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        while True:
+            print('Training %d betas for %d steps.' % (len(survivors), num_steps))
+            accuracies = pool.map(sweep_trial, [
+                (train_fn, beta, num_steps, splits_dir, threads_per_trial)
+                for beta in survivors])
+            for beta, (valid_accuracy, test_accuracy) in zip(survivors, accuracies):
+                results[beta] = (num_steps, valid_accuracy, test_accuracy)
+            if num_steps >= max_steps or len(survivors) == 1:
+                break
+            survivors = sorted(survivors, key=lambda beta: -results[beta][1])
+            survivors = survivors[:max(1, len(survivors) // eta)]
+            # The last remaining beta gets the full budget.
+            num_steps = max_steps if len(survivors) == 1 else min(num_steps * eta, max_steps)
+    finally:
+        pool.close()
+        pool.join()
+
+    for beta in survivors:
+        print("L2 regularization(beta=%.5f) Test accuracy: %.1f%%" % (beta, results[beta][2]))
+    best_beta = max(survivors, key=lambda beta: results[beta][1])
+    print('Best beta=%f, accuracy=%.1f%%' % (best_beta, results[best_beta][2]))
+    return best_beta, results[best_beta][2], results
+
+def train_batched(beta_val, num_steps, splits_dir, hidden_size=None, batch_size=128,
+                  chunk_size=1000):
+    """Train one model per beta in a single graph. The weights of all models are
+    stacked along a leading model axis, so each step runs one batched matmul per
+    layer for every model at once, on a shared minibatch. Without hidden_size
+    the models are the logistic regression of the sweep, otherwise the network
+    with one hidden layer of that size. Since the total loss is a sum of the
+    per-model losses, every model is trained exactly as it would be alone.
+    Returns the validation and test accuracy of each model."""
+    splits = load_splits(splits_dir)
+    flat = lambda dataset: dataset.reshape((-1, image_size * image_size))
+    one_hot = lambda labels: (np.arange(num_classes) == labels[:, None]).astype(np.float32)
+    train_dataset, train_labels = flat(splits['train_dataset']), splits['train_labels']
+    num_models = len(beta_val)
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf_train_dataset = tf.placeholder(tf.float32, shape=(batch_size, image_size * image_size))
+        tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_classes))
+        tf_eval_dataset = tf.placeholder(tf.float32, shape=(None, image_size * image_size))
+        tf_beta = tf.constant(np.asarray(beta_val, dtype=np.float32))
+
+        # Variables, one slice along the first axis per model.
+        if hidden_size is None:
+            sizes = [image_size * image_size, num_classes]
+        else:
+            sizes = [image_size * image_size, hidden_size, num_classes]
+        weights = [tf.Variable(tf.truncated_normal([num_models, n_in, n_out]))
+                   for n_in, n_out in zip(sizes[:-1], sizes[1:])]
+        biases = [tf.Variable(tf.zeros([num_models, 1, n_out])) for n_out in sizes[1:]]
+
+        def model(data):
+            # [batch, in] x [models, in, out] -> [models, batch, out]
+            y = tf.transpose(tf.tensordot(data, weights[0], [[1], [1]]), [1, 0, 2]) + biases[0]
+            for W, b in zip(weights[1:], biases[1:]):
+                y = tf.matmul(tf.nn.relu(y), W) + b
+            return y
+
+        # Training computation: the sum of every model's own loss.
+        logits = model(tf_train_dataset)
+        labels = tf.tile(tf_train_labels[None], [num_models, 1, 1])
+        losses = tf.reduce_mean(
+            tf.nn.softmax_cross_entropy_with_logits(labels=labels, logits=logits), 1)
+        if hidden_size is None:
+            l2 = 0.5 * tf.reduce_sum(tf.square(weights[0]), [1, 2])
+        else:
+            l2 = tf.add_n([0.5 * tf.reduce_sum(tf.square(v), [1, 2]) for v in weights + biases])
+        loss = tf.reduce_sum(losses + tf_beta * l2)
+        optimizer = tf.train.GradientDescentOptimizer(0.5).minimize(loss)
+        eval_predictions = tf.argmax(model(tf_eval_dataset), 2)
+
+    with tf.Session(graph=graph) as session:
+        tf.global_variables_initializer().run()
+        for step in range(num_steps):
+            offset = (step * batch_size) % (train_labels.shape[0] - batch_size)
+            batch_data = normalize(np.array(train_dataset[offset:(offset + batch_size)]))
+            batch_labels = one_hot(train_labels[offset:(offset + batch_size)])
+            session.run(optimizer, feed_dict={tf_train_dataset: batch_data,
+                                              tf_train_labels: batch_labels})
+        accuracies = []
+        for name in ('valid', 'test'):
+            dataset, labels = flat(splits[name + '_dataset']), np.array(splits[name + '_labels'])
+            correct = np.zeros(num_models)
+            for offset in range(0, labels.shape[0], chunk_size):
+                chunk = normalize(np.array(dataset[offset:(offset + chunk_size)]))
+                predictions = session.run(eval_predictions, feed_dict={tf_eval_dataset: chunk})
+                correct += np.sum(predictions == labels[offset:(offset + chunk_size)], 1)
+            accuracies.append(100.0 * correct / labels.shape[0])
+
+    for beta, test_accuracy in zip(beta_val, accuracies[1]):
+        print("L2 regularization(beta=%.5f) Test accuracy: %.1f%%" % (beta, test_accuracy))
+    return accuracies[0], accuracies[1]
+
 
 
 # beta_val = np.logspace(-4, -2, 20)
@@ -441,6 +1220,12 @@ def accuracy(predictions, labels):
 # plt.title('Test accuracy by regularization (logistic)')
 # plt.show()
 
+# The same sweep on all cores, dropping the clearly losing betas early.
+# best_beta, best_accuracy, sweep_results = run_sweep(train_logistic, beta_val, splits_dir)
+
+# Or train all of the betas at once in one batched graph.
+# _, accuracy_val = train_batched(beta_val, num_steps, splits_dir)
+
 # NN model
 # batch_size = 128
 # hidden_size = 1024
@@ -516,6 +1301,9 @@ def accuracy(predictions, labels):
 # plt.title('Test accuracy by regularization (logistic)')
 # plt.show()
 
+# All of the betas at once in one batched graph.
+# _, accuracy_val = train_batched(beta_val, num_steps, splits_dir, hidden_size)
+
 
 # ---
 # Problem 2
@@ -781,6 +1569,13 @@ def accuracy(predictions, labels):
 #             print("Validation accuracy: %.1f%%" % accuracy(
 #                 valid_prediction.eval(), valid_labels))
 #     print("Final Test accuracy: %.1f%%" % accuracy(test_prediction.eval(), test_labels))
+#     mlp_weights = session.run({'W1': W1, 'b1': b1, 'W2': W2, 'b2': b2,
+#                                'W3': W3, 'b3': b3, 'W4': W4, 'b4': b4})
+
+# # Quantize it to int8 and compare with the float model.
+# mlp_layers = quantize.mlp_layers(mlp_weights)
+# mlp_int8 = quantize.quantize(mlp_layers, valid_dataset[:1000])
+# quantize.print_report(quantize.accuracy_report(mlp_layers, mlp_int8, test_dataset, test_labels))
 
 
 ##Assignment 4
@@ -790,8 +1585,11 @@ num_labels = 10
 num_channels = 1 # grayscale
 
 def reformat(dataset, labels):
-  dataset = dataset.reshape(
-    (-1, image_size, image_size, num_channels)).astype(np.float32)
+  # Raw uint8 pixels are only reshaped, and get normalized batch by batch.
+  # copy=False keeps a memory-mapped float32 dataset mapped instead of loading it.
+  dataset = dataset.reshape((-1, image_size, image_size, num_channels))
+  if dataset.dtype != np.uint8:
+    dataset = dataset.astype(np.float32, copy=False)
   labels = (np.arange(num_labels) == labels[:,None]).astype(np.float32)
   return dataset, labels
 train_dataset, train_labels = reformat(train_dataset, train_labels)
@@ -970,6 +1768,7 @@ patch_size = 5
 depth = 32
 num_hidden = 64
 num_steps = 30001
+eval_chunk_size = 1000  # Validation and test images evaluated per session.run.
 
 graph = tf.Graph()
 
@@ -978,8 +1777,10 @@ with graph.as_default():
     tf_train_dataset = tf.placeholder(
         tf.float32, shape=(batch_size, image_size, image_size, num_channels))
     tf_train_labels = tf.placeholder(tf.float32, shape=(batch_size, num_labels))
-    tf_valid_dataset = tf.constant(valid_dataset)
-    tf_test_dataset = tf.constant(test_dataset)
+    # Validation and test images are fed in chunks rather than baked into the
+    # graph as constants, which keeps the graph small and eval memory bounded.
+    tf_eval_dataset = tf.placeholder(
+        tf.float32, shape=(None, image_size, image_size, num_channels))
     global_step = tf.Variable(0)  # count the number of steps taken.
 
     # Variables.
@@ -1006,7 +1807,7 @@ with graph.as_default():
         pool2 = tf.nn.max_pool(conv2, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
 
         shape = pool2.get_shape().as_list()
-        reshape = tf.reshape(pool2, [shape[0], shape[1] * shape[2] * shape[3]])
+        reshape = tf.reshape(pool2, [-1, shape[1] * shape[2] * shape[3]])
         fc1 = tf.nn.relu(tf.matmul(reshape, layer3_weights) + layer3_biases)
         fc1_drop = tf.nn.dropout(fc1, keep_prob)
 
@@ -1026,24 +1827,70 @@ with graph.as_default():
 
     # Predictions for the training, validation, and test data.
     train_prediction = tf.nn.softmax(logits)
-    valid_prediction = tf.nn.softmax(model(tf_valid_dataset, 1))
-    test_prediction = tf.nn.softmax(model(tf_test_dataset, 1))
+    eval_prediction = tf.nn.softmax(model(tf_eval_dataset, 1))
+
+    # Everything a resumed run needs, including global_step.
+    checkpoint_variables = tf.global_variables()
+
 
+shuffle_batches = False  # Reshuffle the training set every epoch.
+checkpoint_dir = os.path.join(data_root, 'lenet_checkpoints')
+checkpoint_every = 1000  # Steps between checkpoints.
+lenet_model_file = os.path.join(data_root, 'lenet.npz')
+profile_log = os.path.join(data_root, 'lenet_profile.jsonl')  # Per-step timings, or None.
+trace_steps = [100]  # Steps whose TensorFlow timeline is saved, for chrome://tracing.
 
 with tf.Session(graph=graph) as session:
     tf.initialize_all_variables().run()
     print('Initialized')
-    for step in range(num_steps):
-        offset = (step * batch_size) % (train_labels.shape[0] - batch_size)
-        batch_data = train_dataset[offset:(offset + batch_size), :, :, :]
-        batch_labels = train_labels[offset:(offset + batch_size), :]
-        feed_dict = {tf_train_dataset: batch_data, tf_train_labels: batch_labels}
-        _, l, predictions = session.run(
-            [optimizer, loss, train_prediction], feed_dict=feed_dict)
+    checkpointer = checkpoint.AsyncCheckpointer(checkpoint_dir, checkpoint_variables)
+    # Batches only depend on the step, so the step is the whole data cursor.
+    last_step, _ = checkpointer.restore(session)
+    start_step = 0 if last_step is None else last_step + 1
+    train_batches = BatchPrefetcher(train_dataset, train_labels, batch_size,
+                                    start_step=start_step, shuffle=shuffle_batches)
+    step_timer = profiling.StepTimer('lenet', profile_log, trace_steps, data_root)
+    for step in range(start_step, num_steps):
+        step_timer.start_step(step)
+        with step_timer.phase('fetch'):
+            batch_data, batch_labels = train_batches.next()
+        with step_timer.phase('feed'):
+            feed_dict = {tf_train_dataset: batch_data, tf_train_labels: batch_labels}
+        with step_timer.phase('compute'):
+            _, l, predictions = session.run(
+                [optimizer, loss, train_prediction], feed_dict=feed_dict,
+                **step_timer.run_args(step))
+        step_timer.count('images', batch_size)
         if (step % 300 == 0):
-            print('Minibatch loss at step %d: %f' % (step, l))
-            print('Minibatch accuracy: %.1f%%' % accuracy(predictions, batch_labels))
-            print('Validation accuracy: %.1f%%' % accuracy(
-                valid_prediction.eval(), valid_labels))
-    print('Lenet 5 Test accuracy: %.1f%%' % accuracy(test_prediction.eval(), test_labels))
+            with step_timer.phase('eval'):
+                print('Minibatch loss at step %d: %f' % (step, l))
+                print('Minibatch accuracy: %.1f%%' % accuracy(predictions, batch_labels))
+                print('Validation accuracy: %.1f%%' % evaluate(
+                    session, eval_prediction, tf_eval_dataset, valid_dataset, valid_labels,
+                    eval_chunk_size))
+        if step % checkpoint_every == 0:
+            with step_timer.phase('checkpoint'):
+                checkpointer.save(session, step)
+        step_timer.end_step()
+    step_timer.close()
+    train_batches.close()
+    checkpointer.close()
+    print('Lenet 5 Test accuracy: %.1f%%' % evaluate(
+        session, eval_prediction, tf_eval_dataset, test_dataset, test_labels,
+        eval_chunk_size))
+    # Export the weights for lenet_numpy, which serves the model without TensorFlow.
+    lenet_numpy.save_model(lenet_model_file, session.run({
+        'layer1_weights': layer1_weights, 'layer1_biases': layer1_biases,
+        'layer2_weights': layer2_weights, 'layer2_biases': layer2_biases,
+        'layer3_weights': layer3_weights, 'layer3_biases': layer3_biases,
+        'layer4_weights': layer4_weights, 'layer4_biases': layer4_biases}))
+    print('Exported model to', lenet_model_file)
+
+# Post-training int8 quantization of the exported model: a quarter of the weight
+# memory. It runs on float BLAS, so inference is no faster than float.
+calibration_size = 1000  # Validation images used to calibrate activation scales.
+lenet_layers = quantize.lenet_layers(lenet_numpy.load_model(lenet_model_file))
+lenet_int8 = quantize.quantize(lenet_layers, valid_dataset[:calibration_size])
+quantize.save_quantized(os.path.join(data_root, 'lenet_int8.npz'), lenet_int8)
+quantize.print_report(quantize.accuracy_report(lenet_layers, lenet_int8, test_dataset, test_labels))
 
@@ -1,101 +1,156 @@
 from __future__ import print_function
-import collections
+import checkpoint
+import corpus
+import download
+import json
 import math
 import numpy as np
 import os
+import profiling
 import random
+import sampling
+import shutil
 import string
 import tensorflow as tf
-import zipfile
 from matplotlib import pylab
 from six.moves import range
-from six.moves.urllib.request import urlretrieve
 from sklearn.manifold import TSNE
 
 url = 'http://mattmahoney.net/dc/'
 
 def maybe_download(filename, expected_bytes):
   """Download a file if not present, and make sure it's the right size."""
-  if not os.path.exists(filename):
-    filename, _ = urlretrieve(url + filename, filename)
-  statinfo = os.stat(filename)
-  if statinfo.st_size == expected_bytes:
-    print('Found and verified %s' % filename)
-  else:
-    print(statinfo.st_size)
-    raise Exception(
-      'Failed to verify ' + filename + '. Can you get to it with a browser?')
+  download.maybe_download(url + filename, filename, expected_bytes)
+  print('Found and verified %s' % filename)
   return filename
 
 filename = maybe_download('text8.zip', 31344016)
 
-def read_data(filename):
-  """Extract the first file enclosed in a zip file as a list of words"""
-  with zipfile.ZipFile(filename) as f:
-    data = tf.compat.as_str(f.read(f.namelist()[0])).split()
-  return data
-  
-words = read_data(filename)
-print('Data size %d' % len(words))
-
 vocabulary_size = 50000
 
-def build_dataset(words):
+def build_dataset(word_chunks, ids_filename=None):
+  """Map words, given as an iterable of lists of words, to ids: the
+  vocabulary_size - 1 most common words ranked by count, and everything else
+  to 'UNK' (0). data is an int32 array, or with ids_filename an int32 file
+  mapped into memory, so the corpus never has to fit in memory.
+
+  Every distinct word is first numbered in order of appearance, with one dict
+  lookup per word written straight into an int32 array. Ranking these ids by
+  count, ties broken by first appearance, gives the same vocabulary as
+  Counter.most_common. The ids are then turned into ranks in place.
+  """
+  first_seen = dict()
+  counts = np.zeros(0, dtype=np.int64)
+  chunks = []
+  ids_file = open(ids_filename, 'wb') if ids_filename else None
+  try:
+    for words in word_chunks:
+      ids = np.fromiter((first_seen.setdefault(word, len(first_seen)) for word in words),
+                        dtype=np.int32, count=len(words))
+      counts = np.concatenate([counts, np.zeros(len(first_seen) - len(counts), dtype=np.int64)])
+      counts += np.bincount(ids, minlength=len(first_seen))
+      if ids_file:
+        ids.tofile(ids_file)
+      else:
+        chunks.append(ids)
+  finally:
+    if ids_file:
+      ids_file.close()
+  if ids_filename:
+    data = np.memmap(ids_filename, dtype=np.int32, mode='r+')
+  else:
+    data = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+  seen_words = list(first_seen)
+  ranked = np.lexsort((np.arange(len(counts)), -counts))[:vocabulary_size - 1]
   count = [['UNK', -1]]
-  count.extend(collections.Counter(words).most_common(vocabulary_size - 1))
-  dictionary = dict()
-  for word, _ in count:
-    dictionary[word] = len(dictionary)
-  data = list()
+  count.extend((seen_words[i], int(counts[i])) for i in ranked)
+  dictionary = dict((word, i) for i, (word, _) in enumerate(count))
+  rank = np.zeros(len(counts), dtype=np.int32)  # dictionary['UNK'] unless ranked.
+  rank[ranked] = np.arange(1, len(ranked) + 1)
   unk_count = 0
-  for word in words:
-    if word in dictionary:
-      index = dictionary[word]
-    else:
-      index = 0  # dictionary['UNK']
-      unk_count = unk_count + 1
-    data.append(index)
+  for start in range(0, len(data), corpus.chunk_size):
+    ids = data[start:start + corpus.chunk_size]
+    np.take(rank, ids, out=ids)
+    unk_count += int(np.count_nonzero(ids == 0))
   count[0][1] = unk_count
-  reverse_dictionary = dict(zip(dictionary.values(), dictionary.keys())) 
+  if ids_filename:
+    data.flush()
+  reverse_dictionary = dict(zip(dictionary.values(), dictionary.keys()))
+  return data, count, dictionary, reverse_dictionary
+
+def load_dataset(filename, cache_dir):
+  """build_dataset of the words of a zipped corpus, cached in cache_dir under
+  the hash of the corpus and vocabulary_size. The words are streamed from the
+  zip file and their ids written to the cache, so neither the text nor the
+  ids have to fit in memory; later runs just map the cached ids."""
+  cache = os.path.join(cache_dir, '%s-%d' % (download.file_digest(filename)[:16],
+                                             vocabulary_size))
+  if not os.path.exists(os.path.join(cache, 'count.json')):
+    # Built aside and renamed into place, so an interrupted build is not reused.
+    building = cache + '.tmp'
+    if os.path.exists(building):
+      shutil.rmtree(building)
+    os.makedirs(building)
+    data, count, _, _ = build_dataset(corpus.read_words(filename),
+                                      os.path.join(building, 'data.int32'))
+    del data
+    with open(os.path.join(building, 'count.json'), 'w') as f:
+      json.dump(count, f)
+    os.rename(building, cache)
+  else:
+    print('Loading tokenized corpus from', cache)
+  with open(os.path.join(cache, 'count.json')) as f:
+    count = json.load(f)
+  count = count[:1] + [tuple(c) for c in count[1:]]
+  data = np.memmap(os.path.join(cache, 'data.int32'), dtype=np.int32, mode='r')
+  dictionary = dict((word, i) for i, (word, _) in enumerate(count))
+  reverse_dictionary = dict(zip(dictionary.values(), dictionary.keys()))
   return data, count, dictionary, reverse_dictionary
 
-data, count, dictionary, reverse_dictionary = build_dataset(words)
+corpus_cache_dir = 'corpus_cache'  # Tokenized corpora, by corpus hash and vocabulary size.
+
+data, count, dictionary, reverse_dictionary = load_dataset(filename, corpus_cache_dir)
+print('Data size %d' % len(data))
 print('Most common words (+UNK)', count[:5])
 print('Sample data', data[:10])
-del words  # Hint to reduce memory.
 
 
 # data_index = 0
 
-# def generate_batch(batch_size, num_skips, skip_window):
-#   global data_index
-#   assert batch_size % num_skips == 0
-#   assert num_skips <= 2 * skip_window
-#   batch = np.ndarray(shape=(batch_size), dtype=np.int32)
-#   labels = np.ndarray(shape=(batch_size, 1), dtype=np.int32)
-#   span = 2 * skip_window + 1 # [ skip_window target skip_window ]
-#   buffer = collections.deque(maxlen=span)
-#   for _ in range(span):
-#     buffer.append(data[data_index])
-#     data_index = (data_index + 1) % len(data)
-#   for i in range(batch_size // num_skips):
-#     target = skip_window  # target label at the center of the buffer
-#     targets_to_avoid = [ skip_window ]
-#     for j in range(num_skips):
-#       while target in targets_to_avoid:
-#         target = random.randint(0, span - 1)
-#       targets_to_avoid.append(target)
-#       batch[i * num_skips + j] = buffer[skip_window]
-#       labels[i * num_skips + j, 0] = buffer[target]
-#     buffer.append(data[data_index])
-#     data_index = (data_index + 1) % len(data)
-#   return batch, labels
+def generate_skipgram_batch(batch_size, num_skips, skip_window, dynamic_window=False):
+  """Skip-gram pairs for batch_size // num_skips consecutive center words, each
+  paired with num_skips distinct context words drawn from its window.
+
+  With dynamic_window, the window of each center is shrunk to a random size,
+  as word2vec does to weigh close words more, between skip_window and the
+  smallest size that still holds num_skips context words.
+  """
+  global data_index
+  assert batch_size % num_skips == 0
+  assert num_skips <= 2 * skip_window
+  num_centers = batch_size // num_skips
+  span = 2 * skip_window + 1 # [ skip_window target skip_window ]
+  tokens = data.take(np.arange(data_index, data_index + num_centers + span - 1), mode='wrap')
+  windows = np.lib.stride_tricks.as_strided(
+    tokens, shape=(num_centers, span), strides=(tokens.strides[0], tokens.strides[0]),
+    writeable=False)
+  offsets = np.r_[0:skip_window, skip_window + 1:span]
+  # Sorting random keys picks num_skips distinct offsets per center in one go.
+  keys = np.random.random_sample((num_centers, len(offsets)))
+  if dynamic_window:
+    window = np.random.randint((num_skips + 1) // 2, skip_window + 1, size=(num_centers, 1))
+    keys[np.abs(offsets - skip_window) > window] += 1.0  # Sorted after every offset inside.
+  picked = offsets[np.argsort(keys, axis=1)[:, :num_skips]]
+  batch = np.repeat(windows[:, skip_window], num_skips)
+  labels = windows[np.arange(num_centers)[:, None], picked].reshape((batch_size, 1))
+  data_index = (data_index + span + num_centers) % len(data)
+  return batch, labels
 
 # print('data:', [reverse_dictionary[di] for di in data[:8]])
 
 # for num_skips, skip_window in [(2, 1), (4, 2)]:
 #     data_index = 0
-#     batch, labels = generate_batch(batch_size=8, num_skips=num_skips, skip_window=skip_window)
+#     batch, labels = generate_skipgram_batch(batch_size=8, num_skips=num_skips, skip_window=skip_window)
 #     print('\nwith num_skips = %d and skip_window = %d:' % (num_skips, skip_window))
 #     print('    batch:', [reverse_dictionary[bi] for bi in batch])
 #     print('    labels:', [reverse_dictionary[li] for li in labels.reshape(8)])
@@ -108,6 +163,7 @@ del words  # Hint to reduce memory.
 # embedding_size = 128 # Dimension of the embedding vector.
 # skip_window = 1 # How many words to consider left and right.
 # num_skips = 2 # How many times to reuse an input to generate a label.
+# dynamic_window = False # Shrink each window to a random size, as word2vec does.
 # # We pick a random validation set to sample nearest neighbors. here we limit the
 # # validation samples to the words that have a low numeric ID, which by
 # # construction are also the most frequent. 
@@ -164,8 +220,8 @@ del words  # Hint to reduce memory.
 #   print('Initialized')
 #   average_loss = 0
 #   for step in range(num_steps):
-#     batch_data, batch_labels = generate_batch(
-#       batch_size, num_skips, skip_window)
+#     batch_data, batch_labels = generate_skipgram_batch(
+#       batch_size, num_skips, skip_window, dynamic_window)
 #     feed_dict = {train_dataset : batch_data, train_labels : batch_labels}
 #     _, l = session.run([optimizer, loss], feed_dict=feed_dict)
 #     average_loss += l
@@ -208,7 +264,7 @@ del words  # Hint to reduce memory.
 # words = [reverse_dictionary[i] for i in range(1, num_points+1)]
 # plot(two_d_embeddings, words)
 
- ---
+# ---
 # 
 # Problem
 # -------
@@ -221,20 +277,16 @@ data_index = 0
 def generate_batch(batch_size, bag_window):
     global data_index
     span = 2 * bag_window + 1 # [ bag_window target bag_window ]
-    batch = np.ndarray(shape=(batch_size, span - 1), dtype=np.int32)
-    labels = np.ndarray(shape=(batch_size, 1), dtype=np.int32)
-    buffer = collections.deque(maxlen=span)
-    for _ in range(span):
-        buffer.append(data[data_index])
-        data_index = (data_index + 1) % len(data)
-    for i in range(batch_size):
-        # just for testing
-        buffer_list = list(buffer)
-        labels[i, 0] = buffer_list.pop(bag_window)
-        batch[i] = buffer_list
-        # iterate to the next buffer
-        buffer.append(data[data_index])
-        data_index = (data_index + 1) % len(data)
+    # Gather the tokens of all the windows at once, wrapping around the end of
+    # data, and view row i as the window starting at token i.
+    tokens = data.take(np.arange(data_index, data_index + batch_size + span - 1), mode='wrap')
+    windows = np.lib.stride_tricks.as_strided(
+        tokens, shape=(batch_size, span), strides=(tokens.strides[0], tokens.strides[0]),
+        writeable=False)
+    labels = windows[:, bag_window:bag_window + 1].copy()
+    batch = windows[:, np.r_[0:bag_window, bag_window + 1:span]]
+    # Skip ahead as far as the sliding buffer this replaced did.
+    data_index = (data_index + span + batch_size) % len(data)
     return batch, labels
 
 print('data:', [reverse_dictionary[di] for di in data[:16]])
@@ -246,6 +298,27 @@ for bag_window in [1, 2]:
     print('    batch:', [[reverse_dictionary[w] for w in bi] for bi in batch])
     print('    labels:', [reverse_dictionary[li] for li in labels.reshape(4)])
 
+def subsample_dataset(data, count, threshold, seed=0):
+    """sampling.subsample of the ids mapped by load_dataset, cached next to
+    them by threshold and seed, and mapped read-only like them."""
+    cache = os.path.join(os.path.dirname(data.filename),
+                         'subsampled-%g-%d.int32' % (threshold, seed))
+    if not os.path.exists(cache):
+        word_counts = np.array([c for _, c in count], dtype=np.int64)
+        # Written aside and renamed into place, so a partial file is not reused.
+        sampling.subsample(data, sampling.keep_probabilities(word_counts, threshold), seed,
+                           cache + '.tmp')
+        os.rename(cache + '.tmp', cache)
+    return np.memmap(cache, dtype=np.int32, mode='r')
+
+# Drop occurrences of frequent words, as word2vec does: they carry little
+# information and dominate the token stream. None feeds every token. The
+# subsample is seeded, so data_index stays valid when a run resumes.
+subsample_threshold = 1e-3
+if subsample_threshold:
+    data = subsample_dataset(data, count, subsample_threshold)
+    print('Subsampled to %d tokens' % len(data))
+
 batch_size = 128
 embedding_size = 128  # Dimension of the embedding vector.
 bag_window = 2  # How many words to consider left and right.
@@ -256,6 +329,38 @@ valid_size = 16  # Random set of words to evaluate similarity on.
 valid_window = 100  # Only pick dev samples in the head of the distribution.
 valid_examples = np.array(random.sample(range(valid_window), valid_size))
 num_sampled = 64  # Number of negative examples to sample.
+# 'sampled_softmax', or 'negative_sampling', the loss of word2vec, which draws
+# num_sampled negatives per example from the unigram^0.75 table.
+loss_type = 'sampled_softmax'
+if loss_type == 'negative_sampling':
+    negative_table = sampling.unigram_table([c for _, c in count])
+# 'adagrad' is tf.train.AdagradOptimizer, with dense accumulators as large as
+# the tables. 'row_adagrad' keeps one accumulator per row and 'lazy_adam' only
+# updates the Adam moments of the rows in the batch: their work per step
+# doesn't grow with vocabulary_size.
+optimizer_type = 'adagrad'
+
+def row_adagrad(loss, variables, learning_rate, initial_accumulator=0.1):
+    """Adagrad with one accumulator per row of each variable, of the mean
+    squared gradient of the row, applied with scatter updates to the rows
+    that have a gradient only. Embedding lookups and gathers give sparse
+    gradients (IndexedSlices), so only the rows of the batch and the sampled
+    candidates are touched."""
+    updates = []
+    for gradient, variable in zip(tf.gradients(loss, variables), variables):
+        if not isinstance(gradient, tf.IndexedSlices):
+            raise Exception('%s has a dense gradient.' % variable.name)
+        rows, positions = tf.unique(gradient.indices)
+        values = tf.unsorted_segment_sum(gradient.values, positions, tf.shape(rows)[0])
+        flat_values = tf.reshape(values, [tf.shape(rows)[0], -1])
+        accumulator = tf.Variable(tf.fill([int(variable.get_shape()[0])], initial_accumulator),
+                                  trainable=False)
+        accumulated = tf.scatter_add(
+            accumulator, rows, tf.reduce_mean(tf.square(flat_values), 1))
+        scale = learning_rate / tf.sqrt(tf.gather(accumulated, rows))
+        scale = tf.reshape(scale, tf.concat([tf.shape(rows), tf.ones_like(tf.shape(values)[1:])], 0))
+        updates.append(tf.scatter_sub(variable, rows, scale * values))
+    return tf.group(*updates)
 
 graph = tf.Graph()
 
@@ -276,13 +381,31 @@ with graph.as_default(), tf.device('/cpu:0'):
     # Model.
     # Look up embeddings for inputs.
     embeds = tf.nn.embedding_lookup(embeddings, train_dataset)
-    # Compute the softmax loss, using a sample of the negative labels each time.
-    loss = tf.reduce_mean(
-        tf.nn.sampled_softmax_loss(softmax_weights, softmax_biases, tf.reduce_sum(embeds, 1),
-                                   train_labels, num_sampled, vocabulary_size))
+    context = tf.reduce_sum(embeds, 1)
+    if loss_type == 'negative_sampling':
+        # -log sigmoid(true logit) - sum of log sigmoid(-negative logits).
+        train_negatives = tf.placeholder(tf.int32, shape=[batch_size, num_sampled])
+        true_logits = tf.reduce_sum(
+            tf.nn.embedding_lookup(softmax_weights, train_labels[:, 0]) * context, 1) + \
+            tf.gather(softmax_biases, train_labels[:, 0])
+        negative_logits = tf.reduce_sum(
+            tf.nn.embedding_lookup(softmax_weights, train_negatives) * tf.expand_dims(context, 1),
+            2) + tf.gather(softmax_biases, train_negatives)
+        loss = tf.reduce_mean(tf.nn.softplus(-true_logits) +
+                              tf.reduce_sum(tf.nn.softplus(negative_logits), 1))
+    else:
+        # Compute the softmax loss, using a sample of the negative labels each time.
+        loss = tf.reduce_mean(
+            tf.nn.sampled_softmax_loss(softmax_weights, softmax_biases, context,
+                                       train_labels, num_sampled, vocabulary_size))
 
     # Optimizer.
-    optimizer = tf.train.AdagradOptimizer(1.0).minimize(loss)
+    if optimizer_type == 'row_adagrad':
+        optimizer = row_adagrad(loss, [embeddings, softmax_weights, softmax_biases], 1.0)
+    elif optimizer_type == 'lazy_adam':
+        optimizer = tf.contrib.opt.LazyAdamOptimizer(0.01).minimize(loss)
+    else:
+        optimizer = tf.train.AdagradOptimizer(1.0).minimize(loss)
 
     # Compute the similarity between minibatch examples and all embeddings.
     # We use the cosine distance:
@@ -292,17 +415,39 @@ with graph.as_default(), tf.device('/cpu:0'):
         normalized_embeddings, valid_dataset)
     similarity = tf.matmul(valid_embeddings, tf.transpose(normalized_embeddings))
 
+    # Everything a resumed run needs, including the Adagrad accumulators.
+    checkpoint_variables = tf.global_variables()
+
 num_steps = 100001
+checkpoint_dir = 'cbow_checkpoints'
+checkpoint_every = 10000  # Steps between checkpoints.
+profile_log = 'cbow_profile.jsonl'  # Per-step timings, or None.
+trace_steps = [100]  # Steps whose TensorFlow timeline is saved, for chrome://tracing.
 
 with tf.Session(graph=graph) as session:
     tf.initialize_all_variables().run()
     print('Initialized')
+    checkpointer = checkpoint.AsyncCheckpointer(checkpoint_dir, checkpoint_variables)
+    last_step, state = checkpointer.restore(session)
+    start_step = 0
+    if last_step is not None:
+        start_step = last_step + 1
+        data_index = int(state['data_index'])
+    step_timer = profiling.StepTimer('cbow', profile_log, trace_steps)
     average_loss = 0
-    for step in range(num_steps):
-        batch_data, batch_labels = generate_batch(
-            batch_size, bag_window)
-        feed_dict = {train_dataset: batch_data, train_labels: batch_labels}
-        _, l = session.run([optimizer, loss], feed_dict=feed_dict)
+    for step in range(start_step, num_steps):
+        step_timer.start_step(step)
+        with step_timer.phase('fetch'):
+            batch_data, batch_labels = generate_batch(
+                batch_size, bag_window)
+        with step_timer.phase('feed'):
+            feed_dict = {train_dataset: batch_data, train_labels: batch_labels}
+            if loss_type == 'negative_sampling':
+                feed_dict[train_negatives] = negative_table.sample((batch_size, num_sampled))
+        with step_timer.phase('compute'):
+            _, l = session.run([optimizer, loss], feed_dict=feed_dict,
+                               **step_timer.run_args(step))
+        step_timer.count('words', batch_size)
         average_loss += l
         if step % 2000 == 0:
             if step > 0:
@@ -312,18 +457,34 @@ with tf.Session(graph=graph) as session:
             average_loss = 0
         # note that this is expensive (~20% slowdown if computed every 500 steps)
         if step % 10000 == 0:
-            sim = similarity.eval()
-            for i in range(valid_size):
-                valid_word = reverse_dictionary[valid_examples[i]]
-                top_k = 8  # number of nearest neighbors
-                nearest = (-sim[i, :]).argsort()[1:top_k + 1]
-                log = 'Nearest to %s:' % valid_word
-                for k in range(top_k):
-                    close_word = reverse_dictionary[nearest[k]]
-                    log = '%s %s,' % (log, close_word)
-                print(log)
+            with step_timer.phase('eval'):
+                sim = similarity.eval()
+                for i in range(valid_size):
+                    valid_word = reverse_dictionary[valid_examples[i]]
+                    top_k = 8  # number of nearest neighbors
+                    nearest = (-sim[i, :]).argsort()[1:top_k + 1]
+                    log = 'Nearest to %s:' % valid_word
+                    for k in range(top_k):
+                        close_word = reverse_dictionary[nearest[k]]
+                        log = '%s %s,' % (log, close_word)
+                    print(log)
+        if step % checkpoint_every == 0:
+            with step_timer.phase('checkpoint'):
+                checkpointer.save(session, step, {'data_index': data_index})
+        step_timer.end_step()
+    step_timer.close()
+    checkpointer.close()
     final_embeddings = normalized_embeddings.eval()
 
+# # Or train CBOW (or skip-gram) with negative sampling without TensorFlow, with
+# # one worker process per core updating shared tables without locks. data is
+# # already subsampled above.
+# import word2vec_numpy
+# embeddings_val, _ = word2vec_numpy.train(
+#     data, [c for _, c in count], model='cbow', embedding_size=embedding_size,
+#     window=bag_window, negative=num_sampled, epochs=1, subsample_threshold=None)
+# final_embeddings = word2vec_numpy.normalize(embeddings_val)
+
 num_points = 400
 
 tsne = TSNE(perplexity=30, n_components=2, init='pca', n_iter=5000)
@@ -1,47 +1,21 @@
 from __future__ import print_function
-import os
+import corpus
+import download
 import numpy as np
 import random
 import string
-import tensorflow as tf
-import zipfile
 from six.moves import range
-from six.moves.urllib.request import urlretrieve
 
 url = 'http://mattmahoney.net/dc/'
 
 def maybe_download(filename, expected_bytes):
   """Download a file if not present, and make sure it's the right size."""
-  if not os.path.exists(filename):
-    filename, _ = urlretrieve(url + filename, filename)
-  statinfo = os.stat(filename)
-  if statinfo.st_size == expected_bytes:
-    print('Found and verified %s' % filename)
-  else:
-    print(statinfo.st_size)
-    raise Exception(
-      'Failed to verify ' + filename + '. Can you get to it with a browser?')
+  download.maybe_download(url + filename, filename, expected_bytes)
+  print('Found and verified %s' % filename)
   return filename
 
 filename = maybe_download('text8.zip', 31344016)
 
-def read_data(filename):
-  with zipfile.ZipFile(filename) as f:
-    name = f.namelist()[0]
-    data = tf.compat.as_str(f.read(name))
-  return data
-  
-text = read_data(filename)
-print('Data size %d' % len(text))
-
-valid_size = 1000
-valid_text = text[:valid_size]
-train_text = text[valid_size:]
-train_size = len(train_text)
-print(train_size, train_text[:64])
-print(valid_size, valid_text[:64])
-
-
 vocabulary_size = len(string.ascii_lowercase) + 1 # [a-z] + ' '
 first_letter = ord(string.ascii_lowercase[0])
 
@@ -63,6 +37,32 @@ def id2char(dictid):
 print(char2id('a'), char2id('z'), char2id(' '))
 print(id2char(1), id2char(26), id2char(0))
 
+def ids2string(ids):
+  return ''.join(id2char(c) for c in ids)
+
+def read_data(filename, ids_filename):
+  """Stream the characters of the zipped corpus into ids_filename, one uint8
+  char2id per character, and map it read-only, so the text never has to fit
+  in memory."""
+  # Unexpected characters map to ' ', as in char2id.
+  lookup = np.zeros(256, dtype=np.uint8)
+  for char in string.ascii_lowercase + ' ':
+    lookup[ord(char)] = char2id(char)
+  with open(ids_filename, 'wb') as f:
+    for block in corpus.read_blocks(filename):
+      lookup[np.frombuffer(block, dtype=np.uint8)].tofile(f)
+  return np.memmap(ids_filename, dtype=np.uint8, mode='r')
+
+text = read_data(filename, filename + '.chars')
+print('Data size %d' % len(text))
+
+valid_size = 1000
+valid_text = text[:valid_size]
+train_text = text[valid_size:]
+train_size = len(train_text)
+print(train_size, ids2string(train_text[:64]))
+print(valid_size, ids2string(valid_text[:64]))
+
 
 #Function to generate a training batch for the LSTM model.
 
@@ -71,20 +71,20 @@ num_unrollings=10
 
 class BatchGenerator(object):
   def __init__(self, text, batch_size, num_unrollings):
+    """text is an array of character ids, see char2id."""
     self._text = text
     self._text_size = len(text)
     self._batch_size = batch_size
     self._num_unrollings = num_unrollings
     segment = self._text_size // batch_size
-    self._cursor = [ offset * segment for offset in range(batch_size)]
+    self._cursor = np.arange(batch_size) * segment
     self._last_batch = self._next_batch()
   
   def _next_batch(self):
     """Generate a single batch from the current cursor position in the data."""
-    batch = np.zeros(shape=(self._batch_size, vocabulary_size), dtype=np.float)
-    for b in range(self._batch_size):
-      batch[b, char2id(self._text[self._cursor[b]])] = 1.0
-      self._cursor[b] = (self._cursor[b] + 1) % self._text_size
+    batch = np.zeros(shape=(self._batch_size, vocabulary_size), dtype=float)
+    batch[np.arange(self._batch_size), self._text[self._cursor]] = 1.0
+    self._cursor = (self._cursor + 1) % self._text_size
     return batch
   
   def next(self):
@@ -97,6 +97,15 @@ class BatchGenerator(object):
     self._last_batch = batches[-1]
     return batches
 
+  def get_state(self):
+    """The cursors and last batch, to save in a checkpoint."""
+    return {'cursor': np.array(self._cursor), 'last_batch': self._last_batch}
+
+  def set_state(self, state):
+    """Resume from a state returned by get_state."""
+    self._cursor = np.array(state['cursor'], dtype=np.int64)
+    self._last_batch = np.array(state['last_batch'])
+
 def characters(probabilities):
   """Turn a 1-hot encoding or a probability distribution over the possible
   characters back into its (most likely) character representation."""
@@ -137,7 +146,7 @@ def sample_distribution(distribution):
 
 def sample(prediction):
   """Turn a (column) prediction into 1-hot encoded samples."""
-  p = np.zeros(shape=[1, vocabulary_size], dtype=np.float)
+  p = np.zeros(shape=[1, vocabulary_size], dtype=float)
   p[0, sample_distribution(prediction[0])] = 1.0
   return p
 
@@ -148,6 +157,8 @@ def random_distribution():
 
 #Simple LSTM Model.
 
+# import tensorflow as tf
+
 # num_nodes = 64
 
 # graph = tf.Graph()
@@ -226,6 +237,9 @@ def random_distribution():
 
 #   # Predictions.
 #   train_prediction = tf.nn.softmax(logits)
+
+#   # Everything a resumed run needs, including global_step.
+#   checkpoint_variables = tf.global_variables()
   
 #   # Sampling and validation eval: batch 1, no unrolling.
 #   sample_input = tf.placeholder(tf.float32, shape=[1, vocabulary_size])
@@ -243,18 +257,38 @@ def random_distribution():
 
 # num_steps = 7001
 # summary_frequency = 100
+# checkpoint_dir = 'lstm_checkpoints'
+# checkpoint_every = 1000  # Steps between checkpoints.
+# profile_log = 'lstm_profile.jsonl'  # Per-step timings, or None.
+# trace_steps = [100]  # Steps whose TensorFlow timeline is saved, for chrome://tracing.
+
+# import checkpoint
+# import profiling
 
 # with tf.Session(graph=graph) as session:
 #   tf.global_variables_initializer().run()
 #   print('Initialized')
+#   checkpointer = checkpoint.AsyncCheckpointer(checkpoint_dir, checkpoint_variables)
+#   last_step, state = checkpointer.restore(session)
+#   start_step = 0
+#   if last_step is not None:
+#     start_step = last_step + 1
+#     train_batches.set_state(state)
+#   step_timer = profiling.StepTimer('lstm', profile_log, trace_steps)
 #   mean_loss = 0
-#   for step in range(num_steps):
-#     batches = train_batches.next()
-#     feed_dict = dict()
-#     for i in range(num_unrollings + 1):
-#       feed_dict[train_data[i]] = batches[i]
-#     _, l, predictions, lr = session.run(
-#       [optimizer, loss, train_prediction, learning_rate], feed_dict=feed_dict)
+#   for step in range(start_step, num_steps):
+#     step_timer.start_step(step)
+#     with step_timer.phase('fetch'):
+#       batches = train_batches.next()
+#     with step_timer.phase('feed'):
+#       feed_dict = dict()
+#       for i in range(num_unrollings + 1):
+#         feed_dict[train_data[i]] = batches[i]
+#     with step_timer.phase('compute'):
+#       _, l, predictions, lr = session.run(
+#         [optimizer, loss, train_prediction, learning_rate], feed_dict=feed_dict,
+#         **step_timer.run_args(step))
+#     step_timer.count('characters', batch_size * num_unrollings)
 #     mean_loss += l
 #     if step % summary_frequency == 0:
 #       if step > 0:
@@ -266,27 +300,34 @@ def random_distribution():
 #       labels = np.concatenate(list(batches)[1:])
 #       print('Minibatch perplexity: %.2f' % float(
 #         np.exp(logprob(predictions, labels))))
-#       if step % (summary_frequency * 10) == 0:
-#         # Generate some samples.
-#         print('=' * 80)
-#         for _ in range(5):
-#           feed = sample(random_distribution())
-#           sentence = characters(feed)[0]
-#           reset_sample_state.run()
-#           for _ in range(79):
-#             prediction = sample_prediction.eval({sample_input: feed})
-#             feed = sample(prediction)
-#             sentence += characters(feed)[0]
-#           print(sentence)
-#         print('=' * 80)
-#       # Measure validation set perplexity.
-#       reset_sample_state.run()
-#       valid_logprob = 0
-#       for _ in range(valid_size):
-#         b = valid_batches.next()
-#         predictions = sample_prediction.eval({sample_input: b[0]})
-#         valid_logprob = valid_logprob + logprob(predictions, b[1])
-#       print('Validation set perplexity: %.2f' % float(np.exp(
-#         valid_logprob / valid_size)))
+#       with step_timer.phase('eval'):
+#         if step % (summary_frequency * 10) == 0:
+#           # Generate some samples.
+#           print('=' * 80)
+#           for _ in range(5):
+#             feed = sample(random_distribution())
+#             sentence = characters(feed)[0]
+#             reset_sample_state.run()
+#             for _ in range(79):
+#               prediction = sample_prediction.eval({sample_input: feed})
+#               feed = sample(prediction)
+#               sentence += characters(feed)[0]
+#             print(sentence)
+#           print('=' * 80)
+#         # Measure validation set perplexity.
+#         reset_sample_state.run()
+#         valid_logprob = 0
+#         for _ in range(valid_size):
+#           b = valid_batches.next()
+#           predictions = sample_prediction.eval({sample_input: b[0]})
+#           valid_logprob = valid_logprob + logprob(predictions, b[1])
+#         print('Validation set perplexity: %.2f' % float(np.exp(
+#           valid_logprob / valid_size)))
+#     if step % checkpoint_every == 0:
+#       with step_timer.phase('checkpoint'):
+#         checkpointer.save(session, step, train_batches.get_state())
+#     step_timer.end_step()
+#   step_timer.close()
+#   checkpointer.close()
 
 
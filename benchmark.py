@@ -0,0 +1,530 @@
+"""Micro-benchmarks of the data pipeline and training steps of the assignments,
+on synthetic inputs.
+
+The assignments run everything at import, so the functions and graphs under
+test are read out of their source instead: top-level definitions by name, and
+graphs from their `with graph.as_default():` block (or, for the LSTM of
+assignment6, from its commented-out code). Each stage runs in a fresh process,
+so that its peak RSS is its own.
+
+Stages time the code paths the scripts run. A few time the ones they replaced
+(load_letter, merge_datasets, randomize), as baselines to compare against.
+
+  python benchmark.py                      # every stage, default sizes
+  python benchmark.py merge_datasets merge_shuffled_datasets --size rows=100000 --repeat 50
+  python benchmark.py --output before.json
+  python benchmark.py sparse_adagrad_step --size vocabulary=50000,500000,2000000
+  python benchmark.py cbow_step cbow_row_adagrad_step --size vocabulary=50000,2000000
+
+A size given several values runs the stages once for each.
+"""
+from __future__ import print_function
+import argparse
+import ast
+import collections
+import functools
+import imageio
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+import types
+import numpy as np
+from six.moves import range
+from timeit import default_timer as timer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Size of the synthetic inputs, overridden with --size name=value.
+default_sizes = {
+  'images': 500,  # PNG files in the fake letter folder and archive of the ingest stages.
+  'rows': 20000,  # 28x28 images in the datasets of the merge, shuffle and batch stages.
+  'tokens': 1000000,  # Random token ids for the CBOW and skip-gram batches.
+  'chars': 1000000,  # Random character ids for BatchGenerator.
+  'vocabulary': 50000,  # Vocabulary size of the CBOW and sparse steps.
+}
+
+
+def script_namespace(script, names, namespace=None):
+  """Run the imports of an assignment script and the last top-level
+  definition or assignment of each of names, without the rest of the script.
+  Imports that fail, e.g. TensorFlow on a machine without it, are skipped.
+
+  The namespace is that of a module registered in sys.modules, so that its
+  functions can be pickled to the worker processes of a pool.
+  """
+  path = os.path.join(here, script)
+  with open(path) as f:
+    tree = ast.parse(f.read(), path)
+  if namespace is None:
+    module = types.ModuleType('benchmark_' + script[:-len('.py')])
+    sys.modules[module.__name__] = module
+    namespace = module.__dict__
+  definitions = {}
+  for node in tree.body:
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+      if isinstance(node, ast.ImportFrom) and node.module == '__future__':
+        continue
+      try:
+        exec(compile(ast.Module([node], []), path, 'exec'), namespace)
+      except ImportError:
+        pass
+    elif isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in names:
+      definitions[node.name] = node
+    elif isinstance(node, ast.Assign):
+      for target in node.targets:
+        if isinstance(target, ast.Name) and target.id in names:
+          definitions[target.id] = node
+  missing = set(names) - set(definitions)
+  if missing:
+    raise Exception('%s does not define %s' % (script, ', '.join(sorted(missing))))
+  body = sorted(set(definitions.values()), key=lambda node: node.lineno)
+  exec(compile(ast.Module(body, []), path, 'exec'), namespace)
+  return namespace
+
+
+def run_graph_block(script, defines, namespace):
+  """Run the last top-level `with` block of script that assigns `defines`."""
+  path = os.path.join(here, script)
+  with open(path) as f:
+    tree = ast.parse(f.read(), path)
+  blocks = [node for node in tree.body if isinstance(node, ast.With) and
+            any(isinstance(t, ast.Name) and t.id == defines
+                for n in ast.walk(node) if isinstance(n, ast.Assign) for t in n.targets)]
+  if not blocks:
+    raise Exception('%s has no graph defining %s' % (script, defines))
+  exec(compile(ast.Module(blocks[-1:], []), path, 'exec'), namespace)
+  return namespace
+
+
+def run_commented_block(script, first_line, last_line, namespace):
+  """Uncomment and run the lines of script from first_line up to, but not
+  including, last_line."""
+  with open(os.path.join(here, script)) as f:
+    lines = f.read().splitlines()
+  start = lines.index(first_line)
+  end = next(i for i in range(start, len(lines)) if lines[i].startswith(last_line))
+  source = '\n'.join(line[2:] if line.startswith('# ') else line.lstrip('#')
+                     for line in lines[start:end])
+  exec(compile(source, script, 'exec'), namespace)
+  return namespace
+
+
+class quiet(object):
+  """Silence the progress prints of the code under test."""
+  def __enter__(self):
+    self._stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+  def __exit__(self, *exc_info):
+    sys.stdout.close()
+    sys.stdout = self._stdout
+
+
+def random_images(num_images, seed=0):
+  return np.random.RandomState(seed).randint(0, 256, (num_images, 28, 28)).astype(np.uint8)
+
+
+def normalized_images(num_images, seed=0):
+  return (random_images(num_images, seed) / 255.0 - 0.5).astype(np.float32)
+
+
+# Stages. Each one prepares its inputs and returns the function to time, the
+# number of items it processes per call, and a cleanup function or None.
+
+def write_letter_folders(root, num_images):
+  """Write num_images random PNGs spread over one folder per class, A to J."""
+  for i, image in enumerate(random_images(num_images)):
+    folder = os.path.join(root, 'ABCDEFGHIJ'[i % 10])
+    if not os.path.isdir(folder):
+      os.makedirs(folder)
+    imageio.imwrite(os.path.join(folder, '%d.png' % i), image)
+
+
+def stage_load_letter(sizes, work_dir):
+  ns = script_namespace('assignment1.py', ['image_size', 'pixel_depth', 'read_image',
+                                           'check_letter', 'load_images', 'load_letter'])
+  folder = os.path.join(work_dir, 'A')
+  os.makedirs(folder)
+  for i, image in enumerate(random_images(sizes['images'])):
+    imageio.imwrite(os.path.join(folder, '%d.png' % i), image)
+  return lambda: ns['load_letter'](folder, 0), sizes['images'], None
+
+
+def stage_maybe_pickle_from_tar(sizes, work_dir):
+  """Decode a .tar.gz of letter folders into .npy datasets, as the script does,
+  with its ingest_workers processes."""
+  ns = script_namespace('assignment1.py', ['num_classes', 'image_size', 'pixel_depth',
+                                           'ingest_workers', 'read_image', 'check_letter',
+                                           'save_dataset', 'decode_chunk',
+                                           'read_tar_chunks', 'maybe_pickle_from_tar'])
+  write_letter_folders(os.path.join(work_dir, 'letters'), sizes['images'])
+  archive = os.path.join(work_dir, 'letters.tar.gz')
+  with tarfile.open(archive, 'w:gz') as tar:
+    tar.add(os.path.join(work_dir, 'letters'), 'letters')
+  shutil.rmtree(os.path.join(work_dir, 'letters'))
+  return (lambda: ns['maybe_pickle_from_tar'](archive, 0, force=True,
+                                              num_workers=ns['ingest_workers'], fmt='npy'),
+          sizes['images'], None)
+
+
+def write_class_datasets(ns, sizes, work_dir):
+  """One .npy dataset per class, holding rows // 10 images each."""
+  per_class = sizes['rows'] // 10
+  pickle_files = []
+  for label in range(10):
+    pickle_files.append(os.path.join(work_dir, '%d.npy' % label))
+    ns['save_dataset'](pickle_files[-1], normalized_images(per_class, label))
+  train_size = per_class * 10 * 9 // 10
+  return pickle_files, train_size, per_class * 10 - train_size
+
+
+def stage_merge_datasets(sizes, work_dir):
+  ns = script_namespace('assignment1.py', ['image_size', 'save_dataset', 'load_dataset',
+                                           'make_arrays', 'merge_datasets'])
+  pickle_files, train_size, valid_size = write_class_datasets(ns, sizes, work_dir)
+  return (lambda: ns['merge_datasets'](pickle_files, train_size, valid_size),
+          train_size + valid_size, None)
+
+
+def stage_merge_shuffled_datasets(sizes, work_dir):
+  ns = script_namespace('assignment1.py', ['image_size', 'save_dataset', 'load_dataset',
+                                           'make_arrays', 'gather_rows',
+                                           'merge_shuffled_datasets'])
+  pickle_files, train_size, valid_size = write_class_datasets(ns, sizes, work_dir)
+  return (lambda: ns['merge_shuffled_datasets'](pickle_files, train_size, valid_size),
+          train_size + valid_size, None)
+
+
+def stage_randomize(sizes, work_dir):
+  ns = script_namespace('assignment1.py', ['randomize'])
+  dataset = normalized_images(sizes['rows'])
+  labels = np.random.randint(0, 10, sizes['rows']).astype(np.int32)
+  return lambda: ns['randomize'](dataset, labels), sizes['rows'], None
+
+
+def stage_reformat(pixel_dtype, sizes, work_dir):
+  """reformat of a dataset stored with the given pixel_dtype of the script:
+  normalized float32, or raw uint8 pixels."""
+  ns = script_namespace('assignment1.py', ['image_size', 'num_labels', 'num_channels',
+                                           'reformat'])
+  if pixel_dtype == np.uint8:
+    dataset = random_images(sizes['rows'])
+  else:
+    dataset = normalized_images(sizes['rows'])
+  labels = np.random.randint(0, 10, sizes['rows']).astype(np.int32)
+  return lambda: ns['reformat'](dataset, labels), sizes['rows'], None
+
+
+def stage_batch_prefetcher(sizes, work_dir, batches_per_call=1000):
+  """Minibatches of the LeNet loop, from a memory-mapped training set, as fast
+  as the prefetcher's background thread prepares them."""
+  ns = script_namespace('assignment1.py', ['pixel_depth', 'normalize', 'BatchPrefetcher',
+                                           'batch_size', 'shuffle_batches'])
+  filename = os.path.join(work_dir, 'train_dataset.npy')
+  np.save(filename, normalized_images(sizes['rows']))
+  dataset = np.load(filename, mmap_mode='r')
+  labels = np.random.randint(0, 10, sizes['rows']).astype(np.int32)
+  batches = ns['BatchPrefetcher'](dataset, labels, ns['batch_size'],
+                                  shuffle=ns['shuffle_batches'])
+  return (lambda: [batches.next() for _ in range(batches_per_call)],
+          batches_per_call * ns['batch_size'], batches.close)
+
+
+def stage_generate_batch(sizes, work_dir):
+  ns = script_namespace('assignment5.py', ['data_index', 'generate_batch', 'batch_size',
+                                           'bag_window'])
+  ns['data'] = np.random.randint(0, sizes['vocabulary'], sizes['tokens']).astype(np.int32)
+  return (lambda: ns['generate_batch'](ns['batch_size'], ns['bag_window']),
+          ns['batch_size'], None)
+
+
+def stage_generate_skipgram_batch(sizes, work_dir):
+  ns = script_namespace('assignment5.py', ['data_index', 'generate_skipgram_batch',
+                                           'batch_size'])
+  ns['data'] = np.random.randint(0, sizes['vocabulary'], sizes['tokens']).astype(np.int32)
+  # num_skips and skip_window of the commented-out skip-gram model.
+  return (lambda: ns['generate_skipgram_batch'](ns['batch_size'], 2, 1),
+          ns['batch_size'], None)
+
+
+def stage_batch_generator(sizes, work_dir):
+  ns = script_namespace('assignment6.py', ['vocabulary_size', 'batch_size', 'num_unrollings',
+                                           'BatchGenerator'])
+  text = np.random.randint(0, ns['vocabulary_size'], sizes['chars']).astype(np.uint8)
+  batches = ns['BatchGenerator'](text, ns['batch_size'], ns['num_unrollings'])
+  return batches.next, ns['batch_size'] * ns['num_unrollings'], None
+
+
+def new_graph(ns):
+  """Start a graph in ns, importing TensorFlow there if the script doesn't."""
+  if 'tf' not in ns:
+    try:
+      import tensorflow
+    except ImportError:
+      raise Exception('TensorFlow is not installed')
+    ns['tf'] = tensorflow
+  ns['graph'] = ns['tf'].Graph()
+
+
+def training_step(ns, optimizer, feed_dict):
+  tf = ns['tf']
+  session = tf.Session(graph=ns['graph'])
+  session.run(tf.global_variables_initializer())
+  return lambda: session.run(optimizer, feed_dict=feed_dict), session.close
+
+
+def stage_lenet_step(sizes, work_dir):
+  ns = script_namespace('assignment1.py', ['image_size', 'num_labels', 'num_channels',
+                                           'batch_size', 'patch_size', 'depth',
+                                           'num_hidden', 'num_steps'])
+  new_graph(ns)
+  run_graph_block('assignment1.py', 'eval_prediction', ns)
+  batch_size = ns['batch_size']
+  feed_dict = {
+    ns['tf_train_dataset']: np.random.uniform(-0.5, 0.5, (batch_size, 28, 28, 1)),
+    ns['tf_train_labels']: np.eye(10)[np.random.randint(0, 10, batch_size)]}
+  step, close = training_step(ns, ns['optimizer'], feed_dict)
+  return step, batch_size, close
+
+
+def stage_cbow_step(optimizer_type, sizes, work_dir):
+  """One step of the CBOW graph, with the script's optimizer_type if None.
+  With 'row_adagrad' or 'lazy_adam', the cost of a step should not grow with
+  the vocabulary size."""
+  ns = script_namespace('assignment5.py', ['batch_size', 'embedding_size', 'bag_window',
+                                           'valid_size', 'valid_window', 'valid_examples',
+                                           'num_sampled', 'loss_type', 'optimizer_type',
+                                           'row_adagrad'])
+  ns['vocabulary_size'] = sizes['vocabulary']
+  if optimizer_type is not None:
+    ns['optimizer_type'] = optimizer_type
+  new_graph(ns)
+  run_graph_block('assignment5.py', 'similarity', ns)
+  batch_size, vocabulary_size = ns['batch_size'], sizes['vocabulary']
+  feed_dict = {
+    ns['train_dataset']: np.random.randint(0, vocabulary_size,
+                                           (batch_size, 2 * ns['bag_window'])),
+    ns['train_labels']: np.random.randint(0, vocabulary_size, (batch_size, 1))}
+  if ns['loss_type'] == 'negative_sampling':
+    feed_dict[ns['train_negatives']] = np.random.randint(
+      0, vocabulary_size, (batch_size, ns['num_sampled']))
+  step, close = training_step(ns, ns['optimizer'], feed_dict)
+  return step, batch_size, close
+
+
+def stage_lstm_step(sizes, work_dir):
+  ns = script_namespace('assignment6.py', ['vocabulary_size', 'batch_size',
+                                           'num_unrollings'])
+  new_graph(ns)
+  run_commented_block('assignment6.py', '# num_nodes = 64', '# num_steps', ns)
+  batch_size, vocabulary_size = ns['batch_size'], ns['vocabulary_size']
+  feed_dict = dict(
+    (placeholder, np.eye(vocabulary_size)[np.random.randint(0, vocabulary_size, batch_size)])
+    for placeholder in ns['train_data'])
+  step, close = training_step(ns, ns['optimizer'], feed_dict)
+  return step, batch_size * ns['num_unrollings'], close
+
+
+def stage_sparse_step(optimizer, sizes, work_dir):
+  """One CBOW negative-sampling step of the NumPy engine, with ids spread
+  over the whole vocabulary. Only touched rows are updated, so its cost
+  should not grow with the vocabulary size."""
+  import sampling
+  import word2vec_numpy
+  vocabulary_size, embedding_size, batch_size = sizes['vocabulary'], 128, 128
+  buffers = word2vec_numpy.create_buffers(vocabulary_size, embedding_size, optimizer)
+  counts = np.random.zipf(1.5, vocabulary_size).astype(np.float64)
+  word2vec_numpy.init_worker(buffers, vocabulary_size, embedding_size, None, None,
+                             sampling.unigram_table(counts), {'optimizer': optimizer})
+  inputs = np.random.randint(0, vocabulary_size, (batch_size, 4))
+  mask = np.ones(inputs.shape, dtype=bool)
+  labels = np.random.randint(0, vocabulary_size, batch_size)
+  negatives = word2vec_numpy.shared['negative_table'].sample((batch_size, 5))
+  return (lambda: word2vec_numpy.train_batch(inputs, mask, labels, negatives, 0.01),
+          batch_size, None)
+
+
+stages = [
+  ('maybe_pickle_from_tar', stage_maybe_pickle_from_tar),
+  ('load_letter', stage_load_letter),  # Baseline: decoding an extracted folder.
+  ('merge_shuffled_datasets', stage_merge_shuffled_datasets),
+  ('merge_datasets', stage_merge_datasets),  # Baseline, with randomize below.
+  ('randomize', stage_randomize),
+  ('reformat', functools.partial(stage_reformat, np.float32)),
+  ('reformat_uint8', functools.partial(stage_reformat, np.uint8)),
+  ('batch_prefetcher', stage_batch_prefetcher),
+  ('generate_batch', stage_generate_batch),
+  ('generate_skipgram_batch', stage_generate_skipgram_batch),
+  ('batch_generator', stage_batch_generator),
+  ('lenet_step', stage_lenet_step),
+  ('cbow_step', functools.partial(stage_cbow_step, None)),
+  ('cbow_row_adagrad_step', functools.partial(stage_cbow_step, 'row_adagrad')),
+  ('cbow_lazy_adam_step', functools.partial(stage_cbow_step, 'lazy_adam')),
+  ('lstm_step', stage_lstm_step),
+  ('sparse_sgd_step', functools.partial(stage_sparse_step, 'sgd')),
+  ('sparse_adagrad_step', functools.partial(stage_sparse_step, 'adagrad')),
+  ('sparse_lazy_adam_step', functools.partial(stage_sparse_step, 'lazy_adam')),
+]
+
+
+def peak_rss_mb():
+  """Peak resident set size of this process so far, in MB."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports kilobytes, macOS bytes.
+  return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def measure(fn, items, repeat, warmup=1):
+  """Time repeat calls of fn after warmup untimed ones."""
+  with quiet():
+    for _ in range(warmup):
+      fn()
+    latencies = []
+    for _ in range(repeat):
+      start = timer()
+      fn()
+      latencies.append(timer() - start)
+  latencies = np.array(latencies) * 1000.0
+  return {
+    'items per call': items,
+    'items/sec': items * repeat / (latencies.sum() / 1000.0),
+    'mean ms': latencies.mean(),
+    'p50 ms': np.percentile(latencies, 50),
+    'p90 ms': np.percentile(latencies, 90),
+    'p99 ms': np.percentile(latencies, 99),
+    'max ms': latencies.max(),
+  }
+
+
+def run_stage(args):
+  """Set up and time one stage. Errors, such as a missing TensorFlow, are
+  reported as the result of the stage rather than raised."""
+  name, sizes, repeat, warmup = args
+  np.random.seed(0)
+  work_dir = tempfile.mkdtemp(prefix='benchmark_')
+  try:
+    fn, items, close = dict(stages)[name](sizes, work_dir)
+    baseline = peak_rss_mb()
+    try:
+      result = measure(fn, items, repeat, warmup)
+    finally:
+      if close is not None:
+        close()
+    result['setup peak rss mb'] = baseline
+    result['peak rss mb'] = peak_rss_mb()
+    return result
+  except Exception as e:
+    return {'error': '%s: %s' % (type(e).__name__, e)}
+  finally:
+    shutil.rmtree(work_dir)
+
+
+def send_result(connection, args):
+  connection.send(run_stage(args))
+  connection.close()
+
+
+def run_isolated(args):
+  """run_stage in a process of its own. Not a pool worker, since those can't
+  start the worker processes of the stages that use a pool themselves."""
+  receiver, sender = multiprocessing.Pipe(duplex=False)
+  process = multiprocessing.Process(target=send_result, args=(sender, args))
+  process.start()
+  sender.close()
+  try:
+    return receiver.recv()
+  except EOFError:
+    return {'error': 'Stage process exited with code %s' % process.exitcode}
+  finally:
+    process.join()
+
+
+def run(names, sizes, repeat, warmup=1, isolate=True):
+  results = collections.OrderedDict()
+  for name in names:
+    print('Running', name)
+    if isolate:
+      # One process per stage, so peak RSS doesn't carry over between stages.
+      results[name] = run_isolated((name, sizes, repeat, warmup))
+    else:
+      results[name] = run_stage((name, sizes, repeat, warmup))
+  return results
+
+
+def print_results(results):
+  print('%-40s %12s %10s %10s %10s %10s' % (
+    'stage', 'items/sec', 'p50 ms', 'p90 ms', 'p99 ms', 'peak MB'))
+  for name, result in results.items():
+    if 'error' in result:
+      print('%-40s %s' % (name, result['error']))
+    else:
+      print('%-40s %12.1f %10.2f %10.2f %10.2f %10.1f' % (
+        name, result['items/sec'], result['p50 ms'], result['p90 ms'], result['p99 ms'],
+        result['peak rss mb']))
+
+
+def save_results(filename, results, sizes, repeat):
+  """Write the results with enough context to compare runs."""
+  report = {
+    'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'machine': platform.node(),
+    'platform': platform.platform(),
+    'python': platform.python_version(),
+    'numpy': np.__version__,
+    'cpus': multiprocessing.cpu_count(),
+    'sizes': sizes,
+    'repeat': repeat,
+    'results': results,
+  }
+  with open(filename, 'w') as f:
+    json.dump(report, f, indent=2)
+  print('Saved results to', filename)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('stages', nargs='*', help='Stages to run, all by default: ' +
+                      ', '.join(name for name, _ in stages))
+  parser.add_argument('--size', action='append', default=[], metavar='NAME=VALUE',
+                      help='Input size, one of ' + ', '.join(sorted(default_sizes)))
+  parser.add_argument('--repeat', type=int, default=20, help='Timed calls per stage.')
+  parser.add_argument('--warmup', type=int, default=1, help='Untimed calls per stage.')
+  parser.add_argument('--output', default='benchmark.json', help='JSON results file.')
+  parser.add_argument('--no-isolate', action='store_true',
+                      help='Run the stages in this process; peak RSS is then cumulative.')
+  args = parser.parse_args()
+
+  sizes = dict((name, [value]) for name, value in default_sizes.items())
+  for size in args.size:
+    name, values = size.split('=')
+    if name not in sizes:
+      raise Exception('Unknown size %s, expected one of %s' % (name, ', '.join(sorted(sizes))))
+    sizes[name] = [int(value) for value in values.split(',')]
+  names = args.stages or [name for name, _ in stages]
+  unknown = set(names) - set(dict(stages))
+  if unknown:
+    raise Exception('Unknown stages: ' + ', '.join(sorted(unknown)))
+
+  results = collections.OrderedDict()
+  swept = sorted(name for name, values in sizes.items() if len(values) > 1)
+  for values in itertools.product(*[sizes[name] for name in swept]):
+    configuration = dict((name, values[0]) for name, values in sizes.items())
+    configuration.update(zip(swept, values))
+    suffix = ''.join('[%s=%d]' % item for item in zip(swept, values))
+    for name, result in run(names, configuration, args.repeat, args.warmup,
+                            not args.no_isolate).items():
+      results[name + suffix] = result
+  print_results(results)
+  save_results(args.output, results, sizes, args.repeat)
+
+
+if __name__ == '__main__':
+  main()
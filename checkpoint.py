@@ -0,0 +1,100 @@
+"""Periodic training snapshots written from a background thread."""
+from __future__ import print_function
+import json
+import os
+import threading
+import numpy as np
+from six.moves import queue
+
+
+class AsyncCheckpointer(object):
+  """Save TensorFlow variables, and any data cursors of the training loop, to
+  directory every so often without stalling the loop.
+
+  save() only copies the variable values out of the session; they are written
+  to disk by a background thread, while training goes on. Checkpoints are
+  written to a temporary file and renamed into place, so a preempted write
+  never leaves a broken one behind. The last `keep` checkpoints are kept.
+
+  Pass every variable the run needs to resume, e.g. tf.global_variables(),
+  which includes global_step and the optimizer slots.
+  """
+  def __init__(self, directory, variables, keep=2):
+    self._directory = directory
+    self._variables = list(variables)
+    self._keep = keep
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    # One checkpoint may wait while another is being written. A third save()
+    # blocks until the writer catches up.
+    self._queue = queue.Queue(1)
+    self._error = None
+    self._thread = threading.Thread(target=self._write_loop)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def save(self, session, step, state=None):
+    """Snapshot the variables at `step`, along with `state`, a dict of arrays or
+    numbers such as data cursors."""
+    if self._error is not None:
+      raise self._error
+    values = session.run(self._variables)
+    self._queue.put((step, values, dict(state or {})))
+
+  def _write_loop(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      try:
+        self._write(*item)
+      except Exception as e:
+        print('Unable to write checkpoint for step', item[0], ':', e)
+        self._error = e
+
+  def _write(self, step, values, state):
+    arrays = dict(('variable_%d' % i, value) for i, value in enumerate(values))
+    for name, value in state.items():
+      arrays['state_' + name] = np.asarray(value)
+    filename = os.path.join(self._directory, 'checkpoint-%d.npz' % step)
+    with open(filename + '.tmp', 'wb') as f:
+      np.savez(f, **arrays)
+    os.rename(filename + '.tmp', filename)
+    index = {'step': step, 'filename': os.path.basename(filename),
+             'variables': [v.name for v in self._variables]}
+    with open(os.path.join(self._directory, 'latest.json.tmp'), 'w') as f:
+      json.dump(index, f)
+    os.rename(os.path.join(self._directory, 'latest.json.tmp'),
+              os.path.join(self._directory, 'latest.json'))
+    for old_step in sorted(self._steps())[:-self._keep]:
+      os.remove(os.path.join(self._directory, 'checkpoint-%d.npz' % old_step))
+
+  def _steps(self):
+    return [int(f[len('checkpoint-'):-len('.npz')]) for f in os.listdir(self._directory)
+            if f.startswith('checkpoint-') and f.endswith('.npz')]
+
+  def restore(self, session):
+    """Load the latest checkpoint into the variables. Returns its step and
+    state, or (None, {}) if there is no checkpoint to resume from."""
+    latest = os.path.join(self._directory, 'latest.json')
+    if not os.path.exists(latest):
+      return None, {}
+    with open(latest) as f:
+      index = json.load(f)
+    names = [v.name for v in self._variables]
+    if index['variables'] != names:
+      raise Exception('Checkpoint in %s was saved from a different graph.' % self._directory)
+    with np.load(os.path.join(self._directory, index['filename'])) as arrays:
+      for i, variable in enumerate(self._variables):
+        variable.load(arrays['variable_%d' % i], session)
+      state = dict((name[len('state_'):], arrays[name]) for name in arrays.files
+                   if name.startswith('state_'))
+    print('Restored checkpoint of step %d from %s' % (index['step'], self._directory))
+    return index['step'], state
+
+  def close(self):
+    """Wait for pending checkpoints to be written."""
+    self._queue.put(None)
+    self._thread.join()
+    if self._error is not None:
+      raise self._error
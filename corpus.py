@@ -0,0 +1,45 @@
+"""Stream the text of a zipped corpus, such as text8, without reading it whole."""
+from __future__ import print_function
+import codecs
+import zipfile
+
+chunk_size = 1 << 20  # Bytes decompressed at a time.
+
+
+def read_blocks(filename, chunk_size=chunk_size):
+  """Decompress the first file enclosed in a zip file, yielding chunk_size
+  bytes at a time."""
+  with zipfile.ZipFile(filename) as f:
+    member = f.open(f.namelist()[0])
+    try:
+      for block in iter(lambda: member.read(chunk_size), b''):
+        yield block
+    finally:
+      member.close()
+
+
+def read_chunks(filename, chunk_size=chunk_size):
+  """Yield the text of a zipped corpus a chunk at a time. A UTF-8 character
+  cut by a chunk boundary is decoded whole, with the next chunk."""
+  decoder = codecs.getincrementaldecoder('utf-8')()
+  for block in read_blocks(filename, chunk_size):
+    text = decoder.decode(block)
+    if text:
+      yield text
+  text = decoder.decode(b'', final=True)
+  if text:
+    yield text
+
+
+def read_words(filename, chunk_size=chunk_size):
+  """Yield the whitespace-separated words of a zipped corpus as one list per
+  chunk. A word cut by a chunk boundary is held back and completed with the
+  start of the next chunk."""
+  partial = ''
+  for text in read_chunks(filename, chunk_size):
+    words = (partial + text).split()
+    partial = words.pop() if words and not text[-1].isspace() else ''
+    if words:
+      yield words
+  if partial:
+    yield [partial]
@@ -0,0 +1,169 @@
+"""Resumable, checksummed downloads shared by the assignments."""
+from __future__ import print_function
+import hashlib
+import os
+import shutil
+import socket
+import threading
+import time
+from six.moves.http_client import HTTPException
+from six.moves.urllib.error import URLError
+from six.moves.urllib.request import Request, urlopen
+
+# Directories searched for an already downloaded copy of a file before going to
+# the network, separated like PATH. Useful for a shared cache on a data node.
+mirror_dirs = [d for d in os.environ.get('DOWNLOAD_MIRROR', '').split(os.pathsep) if d]
+
+block_size = 1 << 16
+
+
+def file_digest(filename, algorithm='sha256'):
+  """Hex digest of a file, read in blocks."""
+  digest = hashlib.new(algorithm)
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def verify(filename, expected_bytes=None, sha256=None):
+  """Check that a file exists and has the expected size and content hash.
+  Checks that are given as None are skipped."""
+  if not os.path.exists(filename):
+    return False
+  if expected_bytes is not None and os.stat(filename).st_size != expected_bytes:
+    return False
+  if sha256 is not None and file_digest(filename) != sha256.lower():
+    return False
+  return True
+
+
+def remote_size(url):
+  """Size of a remote file and whether its server accepts range requests."""
+  response = urlopen(Request(url, headers={'Range': 'bytes=0-0'}))
+  try:
+    if response.getcode() == 206:
+      # Content-Range: bytes 0-0/<total>
+      return int(response.headers['Content-Range'].rsplit('/', 1)[1]), True
+    return int(response.headers['Content-Length']), False
+  finally:
+    response.close()
+
+
+def fetch_range(url, part_filename, start=0, end=None, progress=None, retries=5):
+  """Download bytes [start, end] of url to part_filename (end None means up to
+  the end of the file), resuming from what part_filename already holds.
+  Connection errors are retried, each retry resuming where the last one
+  stopped."""
+  for attempt in range(retries + 1):
+    have = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if attempt == 0 and have and progress is not None:
+      progress(have)
+    if end is not None and start + have > end:
+      return
+    first = start + have
+    headers = {}
+    if first > 0 or end is not None:
+      headers['Range'] = 'bytes=%d-%s' % (first, '' if end is None else end)
+    try:
+      response = urlopen(Request(url, headers=headers))
+      try:
+        if first > 0 and response.getcode() != 206:
+          # The server ignored the range, so start over.
+          if end is not None:
+            raise Exception('Server does not support range requests: ' + url)
+          have = 0
+        length = response.headers.get('Content-Length')
+        received = 0
+        with open(part_filename, 'ab' if have else 'wb') as f:
+          for block in iter(lambda: response.read(block_size), b''):
+            f.write(block)
+            received += len(block)
+            if progress is not None:
+              progress(len(block))
+        if length is not None and received < int(length):
+          raise IOError('connection closed after %d of %s bytes' % (received, length))
+      finally:
+        response.close()
+      return
+    except (URLError, HTTPException, socket.error, IOError) as e:
+      if attempt == retries:
+        raise
+      print('\nDownload of %s interrupted (%s), resuming.' % (url, e))
+      time.sleep(min(2 ** attempt, 30))
+
+
+def maybe_download(url, dest_filename, expected_bytes=None, sha256=None,
+                   force=False, num_chunks=1, reporthook=None, mirrors=None):
+  """Download url to dest_filename if it isn't there, and verify it.
+
+  A copy with the right size and hash in one of the mirror directories is used
+  instead of the network. Downloads go to dest_filename + '.part' and resume
+  from it after a dropped connection or a restart. With num_chunks > 1 and a
+  server that accepts range requests, that many ranges are fetched in
+  parallel. reporthook has the urlretrieve signature (count, block_size,
+  total_size).
+  """
+  if not force and verify(dest_filename, expected_bytes, sha256):
+    return dest_filename
+
+  for mirror in (mirror_dirs if mirrors is None else mirrors):
+    mirrored = os.path.join(mirror, os.path.basename(dest_filename))
+    if verify(mirrored, expected_bytes, sha256):
+      print('Copying %s from %s' % (os.path.basename(dest_filename), mirror))
+      shutil.copyfile(mirrored, dest_filename + '.part')
+      os.rename(dest_filename + '.part', dest_filename)
+      return dest_filename
+
+  total_size, ranges = expected_bytes, num_chunks > 1
+  if ranges or total_size is None:
+    total_size, ranges = remote_size(url)
+  lock = threading.Lock()
+  done = [0]
+  def progress(count):
+    with lock:
+      done[0] += count
+      if reporthook is not None and total_size:
+        reporthook(done[0] // block_size, block_size, total_size)
+
+  part_filename = dest_filename + '.part'
+  if force and os.path.exists(part_filename):
+    os.remove(part_filename)
+  if num_chunks > 1 and ranges and total_size:
+    bounds = [total_size * i // num_chunks for i in range(num_chunks + 1)]
+    chunk_filenames = ['%s.%d' % (part_filename, i) for i in range(num_chunks)]
+    if force:
+      for chunk_filename in chunk_filenames:
+        if os.path.exists(chunk_filename):
+          os.remove(chunk_filename)
+    errors = []
+    def fetch_chunk(i):
+      try:
+        fetch_range(url, chunk_filenames[i], bounds[i], bounds[i + 1] - 1, progress)
+      except Exception as e:
+        errors.append(e)
+    threads = [threading.Thread(target=fetch_chunk, args=(i,))
+               for i in range(num_chunks)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if errors:
+      raise errors[0]
+    with open(part_filename, 'wb') as f:
+      for chunk_filename in chunk_filenames:
+        with open(chunk_filename, 'rb') as chunk:
+          shutil.copyfileobj(chunk, f)
+    for chunk_filename in chunk_filenames:
+      os.remove(chunk_filename)
+  elif not (total_size and os.path.exists(part_filename) and
+            os.path.getsize(part_filename) >= total_size):
+    fetch_range(url, part_filename, progress=progress)
+
+  if not verify(part_filename, expected_bytes, sha256):
+    # A corrupt partial download must not be resumed from.
+    os.remove(part_filename)
+    raise Exception(
+      'Failed to verify ' + dest_filename + '. Can you get to it with a browser?')
+  os.rename(part_filename, dest_filename)
+  return dest_filename
@@ -0,0 +1,91 @@
+"""Classify notMNIST letters with the LeNet model of assignment1, using NumPy
+only, so that serving doesn't need TensorFlow."""
+from __future__ import print_function
+import numpy as np
+
+pixel_depth = 255.0  # Number of levels per pixel.
+
+# The exported weights, named as in assignment1.
+weight_names = ['layer1_weights', 'layer1_biases', 'layer2_weights', 'layer2_biases',
+                'layer3_weights', 'layer3_biases', 'layer4_weights', 'layer4_biases']
+
+
+def save_model(filename, weights):
+  """Export a dict of trained weights, as returned by session.run."""
+  np.savez(filename, **dict((name, np.asarray(weights[name], dtype=np.float32))
+                            for name in weight_names))
+
+
+def load_model(filename):
+  with np.load(filename) as f:
+    return dict((name, f[name]) for name in weight_names)
+
+
+def conv2d(data, weights, biases):
+  """2D convolution with stride 1 and 'SAME' padding, as tf.nn.conv2d does it,
+  over NHWC data. The patches are a strided view of the padded input, which
+  tensordot turns into a single matrix multiplication (im2col)."""
+  num_images, height, width, channels = data.shape
+  patch_height, patch_width = weights.shape[:2]
+  # TensorFlow puts the odd padding pixel at the bottom and right.
+  padded = np.pad(data, ((0, 0),
+                         ((patch_height - 1) // 2, patch_height // 2),
+                         ((patch_width - 1) // 2, patch_width // 2),
+                         (0, 0)), 'constant')
+  strides = padded.strides
+  patches = np.lib.stride_tricks.as_strided(
+    padded, shape=(num_images, height, width, patch_height, patch_width, channels),
+    strides=(strides[0], strides[1], strides[2], strides[1], strides[2], strides[3]),
+    writeable=False)
+  return np.tensordot(patches, weights, axes=([3, 4, 5], [0, 1, 2])) + biases
+
+
+def max_pool(data):
+  """2x2 max pooling with stride 2 and 'SAME' padding over NHWC data."""
+  num_images, height, width, channels = data.shape
+  if height % 2 or width % 2:
+    data = np.pad(data, ((0, 0), (0, height % 2), (0, width % 2), (0, 0)),
+                  'constant', constant_values=-np.inf)
+  return data.reshape((num_images, (height + 1) // 2, 2, (width + 1) // 2, 2,
+                       channels)).max(axis=(2, 4))
+
+
+def relu(data):
+  return np.maximum(data, 0)
+
+
+def softmax(logits):
+  exp = np.exp(logits - logits.max(axis=1, keepdims=True))
+  return exp / exp.sum(axis=1, keepdims=True)
+
+
+def normalize(images):
+  """Turn images, raw uint8 or already normalized, into the NHWC float32
+  input of the model."""
+  images = np.asarray(images)
+  if images.dtype == np.uint8:
+    images = (images.astype(np.float32) - pixel_depth / 2) / pixel_depth
+  return images.reshape((images.shape[0], images.shape[1], images.shape[2], 1)).astype(
+    np.float32, copy=False)
+
+
+def logits(model, images):
+  """Forward pass of the model, without dropout."""
+  data = normalize(images)
+  pool1 = max_pool(relu(conv2d(data, model['layer1_weights'], model['layer1_biases'])))
+  pool2 = max_pool(relu(conv2d(pool1, model['layer2_weights'], model['layer2_biases'])))
+  fc1 = relu(np.dot(pool2.reshape((pool2.shape[0], -1)), model['layer3_weights']) +
+             model['layer3_biases'])
+  return np.dot(fc1, model['layer4_weights']) + model['layer4_biases']
+
+
+def predict(model, images, batch_size=256):
+  """Class probabilities for a batch of 28x28 images, computed batch_size
+  images at a time to bound memory."""
+  return np.concatenate([softmax(logits(model, images[start:start + batch_size]))
+                         for start in range(0, len(images), batch_size)])
+
+
+def classify(model, images, batch_size=256):
+  """Most likely letter, 'A' to 'J', of each image."""
+  return [chr(ord('A') + c) for c in np.argmax(predict(model, images, batch_size), 1)]
@@ -0,0 +1,160 @@
+"""Per-step timing of the phases of a training loop."""
+from __future__ import print_function
+import collections
+import json
+import os
+import time
+import numpy as np
+from timeit import default_timer as timer
+
+
+class StepTimer(object):
+  """Time the phases of each training step, e.g. data fetch, feed, compute
+  and eval, and count things such as examples seen.
+
+    timer = StepTimer('lenet', log_file='lenet_profile.jsonl')
+    for step in range(num_steps):
+      timer.start_step(step)
+      with timer.phase('fetch'):
+        batch = ...
+      with timer.phase('compute'):
+        session.run(..., **timer.run_args(step))
+      timer.count('examples', batch_size)
+      timer.end_step()
+    timer.close()
+
+  Every step is written as a JSON line to log_file and passed to each of
+  listeners, callables taking the step record, so other metrics sinks can be
+  plugged in. The log is appended to, after a line marking the start of the
+  run, so that a run resumed from a checkpoint keeps the steps timed before.
+  For the steps in trace_steps, run_args() asks session.run for a full
+  trace, which is saved as a Chrome trace (chrome://tracing) in trace_dir.
+  close() prints a summary table, also logged as the last line.
+  """
+  def __init__(self, name, log_file=None, trace_steps=(), trace_dir='.', listeners=()):
+    self.name = name
+    self._trace_steps = set(trace_steps)
+    self._trace_dir = trace_dir
+    self._listeners = list(listeners)
+    self._log = None
+    if log_file:
+      self._log = open(log_file, 'a')
+      self._log.write(json.dumps({'run': name, 'started': time.time()}) + '\n')
+    self._durations = collections.OrderedDict()
+    self._counts = collections.OrderedDict()
+    self._step_times = []
+    self._record = None
+    self._run_metadata = None
+
+  def start_step(self, step):
+    self._record = {'step': step, 'phases': {}, 'counts': {}}
+    self._step_start = timer()
+
+  def phase(self, name):
+    """Context manager timing one phase of the current step. A phase entered
+    several times in a step adds up."""
+    return _Phase(self, name)
+
+  def _add(self, name, seconds):
+    phases = self._record['phases']
+    phases[name] = phases.get(name, 0.0) + seconds
+
+  def count(self, name, value=1):
+    counts = self._record['counts']
+    counts[name] = counts.get(name, 0) + value
+
+  def run_args(self, step):
+    """Keyword arguments for session.run: a full trace request on the steps
+    to trace, nothing otherwise."""
+    if step not in self._trace_steps:
+      return {}
+    import tensorflow as tf
+    self._run_metadata = tf.RunMetadata()
+    return {'options': tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+            'run_metadata': self._run_metadata}
+
+  def _save_trace(self, step):
+    from tensorflow.python.client import timeline
+    if not os.path.isdir(self._trace_dir):
+      os.makedirs(self._trace_dir)
+    filename = os.path.join(self._trace_dir, '%s_step_%d.json' % (self.name, step))
+    with open(filename, 'w') as f:
+      f.write(timeline.Timeline(self._run_metadata.step_stats).generate_chrome_trace_format())
+    self._record['trace'] = filename
+    self._run_metadata = None
+
+  def end_step(self):
+    record = self._record
+    record['total'] = timer() - self._step_start
+    if self._run_metadata is not None:
+      self._save_trace(record['step'])
+    self._step_times.append(record['total'])
+    for name, seconds in record['phases'].items():
+      self._durations.setdefault(name, []).append(seconds)
+    for name, value in record['counts'].items():
+      self._counts[name] = self._counts.get(name, 0) + value
+    if self._log is not None:
+      self._log.write(json.dumps(record) + '\n')
+    for listener in self._listeners:
+      listener(record)
+    self._record = None
+
+  def summary(self):
+    """Totals and per-step latencies of every phase. 'other' is the part of
+    the steps that no phase covers."""
+    total = sum(self._step_times)
+    phases = collections.OrderedDict(self._durations)
+    phases['other'] = [total - sum(sum(d) for d in self._durations.values())]
+    summary = {'steps': len(self._step_times), 'seconds': total,
+               'phases': collections.OrderedDict(),
+               'per second': dict((name, value / total if total else 0.0)
+                                  for name, value in self._counts.items())}
+    for name, durations in phases.items():
+      durations = np.array(durations) * 1000.0
+      summary['phases'][name] = {
+        'seconds': durations.sum() / 1000.0,
+        'percent': 100.0 * durations.sum() / 1000.0 / total if total else 0.0,
+        'steps': len(durations) if name != 'other' else len(self._step_times),
+        'mean ms': durations.mean(),
+        'p50 ms': np.percentile(durations, 50),
+        'p90 ms': np.percentile(durations, 90),
+        'max ms': durations.max()}
+    return summary
+
+  def print_summary(self, summary=None):
+    summary = summary or self.summary()
+    print('%s: %d steps in %.1fs' % (self.name, summary['steps'], summary['seconds']))
+    print('  %-12s %8s %6s %7s %9s %9s %9s' % (
+      'phase', 'seconds', '%', 'steps', 'mean ms', 'p90 ms', 'max ms'))
+    for name, phase in summary['phases'].items():
+      if name == 'other':
+        print('  %-12s %8.2f %6.1f' % (name, phase['seconds'], phase['percent']))
+      else:
+        print('  %-12s %8.2f %6.1f %7d %9.2f %9.2f %9.2f' % (
+          name, phase['seconds'], phase['percent'], phase['steps'], phase['mean ms'],
+          phase['p90 ms'], phase['max ms']))
+    for name, rate in summary['per second'].items():
+      print('  %s/sec: %.1f' % (name, rate))
+
+  def close(self):
+    """Print the summary and finish the log."""
+    if self._step_times:
+      summary = self.summary()
+      self.print_summary(summary)
+      if self._log is not None:
+        self._log.write(json.dumps({'summary': summary}) + '\n')
+    if self._log is not None:
+      self._log.close()
+      self._log = None
+
+
+class _Phase(object):
+  def __init__(self, step_timer, name):
+    self._step_timer = step_timer
+    self._name = name
+
+  def __enter__(self):
+    self._start = timer()
+
+  def __exit__(self, *exc_info):
+    self._step_timer._add(self._name, timer() - self._start)
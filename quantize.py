@@ -0,0 +1,245 @@
+"""Post-training int8 quantization of the notMNIST classifiers of assignment1.
+
+Weights are quantized symmetrically per output channel, activations per
+tensor with scales calibrated on a slice of the validation set. A model is a
+list of layers, ('conv', weights, biases) or ('fc', weights, biases); every
+conv layer is followed by relu and 2x2 max pooling, every fc layer but the
+last by relu.
+"""
+from __future__ import print_function
+import numpy as np
+import lenet_numpy
+from timeit import default_timer as timer
+
+int8_max = 127
+# Deepest product of int8 values whose sum float32 holds exactly (< 2**24).
+max_exact_depth = (2 ** 24 - 1) // (int8_max * int8_max)
+# Rows of fc weights cast to float at a time, which bounds the scratch memory.
+block_rows = 256
+# What a quantized layer stores.
+stored_keys = ('kind', 'weights', 'weight_scales', 'biases', 'input_scale')
+
+
+def lenet_layers(model):
+  """Layers of the LeNet model, as exported by lenet_numpy.save_model."""
+  return [('conv', model['layer1_weights'], model['layer1_biases']),
+          ('conv', model['layer2_weights'], model['layer2_biases']),
+          ('fc', model['layer3_weights'], model['layer3_biases']),
+          ('fc', model['layer4_weights'], model['layer4_biases'])]
+
+
+def mlp_layers(model):
+  """Layers of the multi-layer perceptron, from a dict of its W1..Wn, b1..bn."""
+  return [('fc', model['W%d' % i], model['b%d' % i])
+          for i in range(1, len([k for k in model if k.startswith('W')]) + 1)]
+
+
+def activation(kind, data, last):
+  if kind == 'conv':
+    return lenet_numpy.max_pool(lenet_numpy.relu(data))
+  return data if last else lenet_numpy.relu(data)
+
+
+def model_input(images):
+  """Normalized float32 images, as 28x28 (NHWC for conv layers) or already
+  flattened rows for the MLP."""
+  images = np.asarray(images)
+  if images.ndim == 2:
+    if images.dtype == np.uint8:
+      images = (images.astype(np.float32) - lenet_numpy.pixel_depth / 2) / lenet_numpy.pixel_depth
+    return images.astype(np.float32, copy=False)
+  return lenet_numpy.normalize(images)
+
+
+def layer_input(kind, data):
+  # fc layers take flat inputs, both after a conv layer and for the MLP.
+  return data.reshape((data.shape[0], -1)) if kind == 'fc' else data
+
+
+def float_logits(layers, images, activations=None):
+  """Float forward pass. If activations is a list, the input of every layer
+  is appended to it."""
+  data = model_input(images)
+  for i, (kind, weights, biases) in enumerate(layers):
+    data = layer_input(kind, data)
+    if activations is not None:
+      activations.append(data)
+    if kind == 'conv':
+      data = lenet_numpy.conv2d(data, weights, biases)
+    else:
+      data = np.dot(data, weights) + biases
+    data = activation(kind, data, i == len(layers) - 1)
+  return data
+
+
+def quantize_weights(weights):
+  """Symmetric int8 quantization with one scale per output channel (the last
+  axis). Returns the int8 weights and the float32 scales."""
+  max_abs = np.abs(weights).reshape((-1, weights.shape[-1])).max(axis=0)
+  scales = np.where(max_abs > 0, max_abs / int8_max, 1.0).astype(np.float32)
+  return np.clip(np.round(weights / scales), -int8_max, int8_max).astype(np.int8), scales
+
+
+def quantize_activations(data, scale, dtype=np.int8):
+  """The int8 values of data, stored as dtype: int8_logits keeps them in
+  float32, which holds them exactly, to feed them to BLAS without a cast."""
+  return np.clip(np.rint(data / scale), -int8_max, int8_max).astype(dtype, copy=False)
+
+
+def quantize(layers, calibration_images, percentile=99.99):
+  """Quantize the weights of a model, and calibrate the scale of every layer
+  input on calibration_images, from the given percentile of its magnitude so
+  that rare outliers don't waste the int8 range."""
+  activations = []
+  float_logits(layers, calibration_images, activations)
+  quantized = []
+  for (kind, weights, biases), data in zip(layers, activations):
+    input_scale = np.percentile(np.abs(data), percentile) / int8_max
+    q_weights, weight_scales = quantize_weights(weights)
+    quantized.append({'kind': kind, 'weights': q_weights, 'weight_scales': weight_scales,
+                      'biases': np.asarray(biases, dtype=np.float32),
+                      'input_scale': np.float32(max(input_scale, 1e-8))})
+  return quantized
+
+
+def weight_blocks(layer):
+  """The int8 weights of a layer in the blocks int_matmul multiplies, with
+  the float dtype each is cast to. NumPy has no int8 GEMM, so the products
+  run in floating point, which is exact as long as every sum fits the float32
+  mantissa. fc weights are cut along their depth into blocks of block_rows,
+  fewer than max_exact_depth, so each fits; a conv layer too deep for that
+  runs in float64."""
+  weights = layer['weights']
+  depth = int(np.prod(weights.shape[:-1]))
+  if layer['kind'] == 'fc':
+    rows = min(block_rows, max_exact_depth)
+    return [(weights[start:start + rows], np.float32) for start in range(0, depth, rows)]
+  return [(weights, np.float32 if depth <= max_exact_depth else np.float64)]
+
+
+def cast_block(block, dtype, scratch):
+  """block cast to dtype, in a buffer of the scratch dict that is reused by
+  every block of that dtype, so the int8 weights are never kept in float."""
+  buffer = scratch.get(dtype)
+  if buffer is None or buffer.size < block.size:
+    buffer = scratch[dtype] = np.empty(block.size, dtype)
+  cast = buffer[:block.size].reshape(block.shape)
+  cast[...] = block
+  return cast
+
+
+def int_matmul(data, layer, scratch):
+  """Convolution or matrix product of the int8 values in data, held in
+  float32, with the int8 weights of layer. The result is the exact integer
+  sum, in floating point."""
+  blocks = weight_blocks(layer)
+  if layer['kind'] == 'conv':
+    weights, dtype = blocks[0]
+    return lenet_numpy.conv2d(data.astype(dtype, copy=False),
+                              cast_block(weights, dtype, scratch), 0)
+  if len(blocks) == 1:
+    return np.dot(data, cast_block(blocks[0][0], np.float32, scratch))
+  # Every block sum is exact in float32, and so is their total up to
+  # max_exact_depth; deeper ones are added up in float64.
+  exact = len(layer['weights']) <= max_exact_depth
+  result = np.zeros((data.shape[0], layer['weights'].shape[1]),
+                    np.float32 if exact else np.float64)
+  start = 0
+  for weights, dtype in blocks:
+    result += np.dot(data[:, start:start + len(weights)], cast_block(weights, dtype, scratch))
+    start += len(weights)
+  return result
+
+
+def int8_logits(quantized, images):
+  """Forward pass of a quantized model: int8 inputs and weights, exact
+  integer accumulation, rescaled to float for the bias, relu and pooling."""
+  data = model_input(images)
+  scratch = {}
+  for i, layer in enumerate(quantized):
+    data = quantize_activations(layer_input(layer['kind'], data), layer['input_scale'],
+                                np.float32)
+    data = int_matmul(data, layer, scratch).astype(np.float32, copy=False)
+    data *= layer['input_scale'] * layer['weight_scales']
+    data += layer['biases']
+    data = activation(layer['kind'], data, i == len(quantized) - 1)
+  return data
+
+
+def model_bytes(layers):
+  return sum(w.nbytes + np.asarray(b).nbytes for _, w, b in layers)
+
+
+def quantized_bytes(quantized):
+  return sum(layer['weights'].nbytes + layer['weight_scales'].nbytes +
+             layer['biases'].nbytes for layer in quantized)
+
+
+def scratch_bytes(quantized):
+  """Size of the scratch buffers int8_logits casts weight blocks into."""
+  largest = {}
+  for layer in quantized:
+    for weights, dtype in weight_blocks(layer):
+      largest[dtype] = max(largest.get(dtype, 0), weights.size * np.dtype(dtype).itemsize)
+  return sum(largest.values())
+
+
+def accuracy_report(layers, quantized, images, labels, batch_size=256):
+  """Compare the float and int8 models on a labelled dataset. labels may be
+  class ids or one-hot."""
+  labels = np.asarray(labels)
+  if labels.ndim == 2:
+    labels = np.argmax(labels, 1)
+  float_predictions, int8_predictions = [], []
+  float_seconds = int8_seconds = 0.0
+  for start in range(0, len(labels), batch_size):
+    batch = np.asarray(images[start:start + batch_size])
+    start_time = timer()
+    float_predictions.append(np.argmax(float_logits(layers, batch), 1))
+    float_seconds += timer() - start_time
+    start_time = timer()
+    int8_predictions.append(np.argmax(int8_logits(quantized, batch), 1))
+    int8_seconds += timer() - start_time
+  float_predictions = np.concatenate(float_predictions)
+  int8_predictions = np.concatenate(int8_predictions)
+  report = {
+    'float accuracy': 100.0 * np.mean(float_predictions == labels),
+    'int8 accuracy': 100.0 * np.mean(int8_predictions == labels),
+    'agreement': 100.0 * np.mean(float_predictions == int8_predictions),
+    'float bytes': model_bytes(layers),
+    'int8 bytes': quantized_bytes(quantized),
+    'scratch bytes': scratch_bytes(quantized),
+    'float seconds': float_seconds,
+    'int8 seconds': int8_seconds}
+  report['accuracy delta'] = report['int8 accuracy'] - report['float accuracy']
+  return report
+
+
+def print_report(report):
+  print('Float accuracy: %.1f%%' % report['float accuracy'])
+  print('Int8 accuracy: %.1f%% (%+.2f%%)' % (report['int8 accuracy'], report['accuracy delta']))
+  print('Predictions agreeing: %.1f%%' % report['agreement'])
+  print('Weights: %d bytes float, %d bytes int8, plus %d bytes of float scratch while '
+        'running' % (report['float bytes'], report['int8 bytes'], report['scratch bytes']))
+  # NumPy has no int8 GEMM: the int8 model runs on float BLAS, so it isn't faster.
+  print('Inference: %.2fs float, %.2fs int8' % (report['float seconds'], report['int8 seconds']))
+
+
+def save_quantized(filename, quantized):
+  arrays = {}
+  for i, layer in enumerate(quantized):
+    for name in stored_keys:
+      arrays['%d_%s' % (i, name)] = np.asarray(layer[name])
+  np.savez(filename, **arrays)
+
+
+def load_quantized(filename):
+  with np.load(filename) as f:
+    quantized = []
+    while '%d_kind' % len(quantized) in f.files:
+      i = len(quantized)
+      layer = dict((name, f['%d_%s' % (i, name)]) for name in
+                   ('weights', 'weight_scales', 'biases', 'input_scale'))
+      layer['kind'] = str(f['%d_kind' % i])
+      quantized.append(layer)
+  return quantized
@@ -0,0 +1,70 @@
+"""word2vec's frequent-word subsampling and unigram negative-sampling table."""
+from __future__ import print_function
+import numpy as np
+
+
+def keep_probabilities(counts, threshold=1e-3):
+  """Probability of keeping each occurrence of a word, from the counts of the
+  vocabulary, with the formula of the word2vec code: words more frequent than
+  threshold are dropped more the more frequent they are, rarer ones never."""
+  counts = np.asarray(counts, dtype=np.float64)
+  frequencies = counts / counts.sum()
+  with np.errstate(divide='ignore', invalid='ignore'):
+    keep = (np.sqrt(frequencies / threshold) + 1) * threshold / frequencies
+  return np.where(counts > 0, np.minimum(keep, 1.0), 1.0)
+
+
+def subsample(data, keep, seed=0, filename=None, chunk_size=1 << 20):
+  """The tokens of data each kept with probability keep[token], as int32. The
+  same seed always keeps the same tokens, so a position in the subsampled
+  stream stays valid when training resumes. With filename, the kept tokens
+  are written there a chunk at a time and returned as a read-only memmap,
+  so the subsampled corpus never has to fit in memory."""
+  random_state = np.random.RandomState(seed)
+  kept = []
+  out = open(filename, 'wb') if filename else None
+  try:
+    for start in range(0, len(data), chunk_size):
+      tokens = np.asarray(data[start:start + chunk_size])
+      tokens = tokens[random_state.random_sample(len(tokens)) < keep[tokens]]
+      if out is not None:
+        tokens.astype(np.int32, copy=False).tofile(out)
+      else:
+        kept.append(tokens)
+  finally:
+    if out is not None:
+      out.close()
+  if filename:
+    return np.memmap(filename, dtype=np.int32, mode='r')
+  return np.concatenate(kept).astype(np.int32, copy=False)
+
+
+class AliasTable(object):
+  """Draw from a fixed discrete distribution in constant time per sample,
+  with Vose's alias method: one uniform column and one coin flip each."""
+  def __init__(self, probabilities):
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    n = len(probabilities)
+    scaled = probabilities * n / probabilities.sum()
+    self._threshold = np.ones(n)
+    self._alias = np.arange(n, dtype=np.int32)
+    small = list(np.nonzero(scaled < 1.0)[0])
+    large = list(np.nonzero(scaled >= 1.0)[0])
+    while small and large:
+      less, more = small.pop(), large.pop()
+      self._threshold[less] = scaled[less]
+      self._alias[less] = more
+      scaled[more] -= 1.0 - scaled[less]
+      (small if scaled[more] < 1.0 else large).append(more)
+    # Whatever is left is 1 up to rounding, and keeps its own column.
+
+  def sample(self, size, random_state=np.random):
+    columns = random_state.randint(0, len(self._alias), size=size)
+    coins = random_state.random_sample(size)
+    return np.where(coins < self._threshold[columns], columns, self._alias[columns]).astype(
+      np.int32)
+
+
+def unigram_table(counts, power=0.75):
+  """Negative-sampling distribution of word2vec: counts raised to power."""
+  return AliasTable(np.asarray(counts, dtype=np.float64) ** power)
@@ -0,0 +1,232 @@
+"""CBOW and skip-gram with negative sampling in NumPy, trained Hogwild style:
+worker processes each take a shard of the id stream and update embedding
+tables in shared memory without locks."""
+from __future__ import print_function
+import multiprocessing
+import time
+import numpy as np
+import sampling
+
+# Tables and settings shared with the worker processes, set by init_worker.
+shared = None
+
+# Per-table state of each optimizer. 'adagrad' is row-wise: one accumulator
+# per row, of the mean squared gradient of the row. 'lazy_adam' keeps Adam's
+# moments per entry, but only decays those of the rows a batch touches.
+optimizer_slots = {'sgd': [], 'adagrad': ['accumulator'], 'lazy_adam': ['m', 'v']}
+default_learning_rates = {'sgd': 0.05, 'adagrad': 0.2, 'lazy_adam': 0.01}
+tables = ['embeddings', 'softmax_weights']
+initial_accumulator = 0.1  # As tf.train.AdagradOptimizer.
+beta1, beta2, epsilon = 0.9, 0.999, 1e-8
+
+
+def create_buffers(vocabulary_size, embedding_size, optimizer='sgd', seed=0):
+  """Shared memory for both tables and the slots of the optimizer."""
+  if optimizer not in optimizer_slots:
+    raise Exception('Unknown optimizer %s, expected one of %s.' % (
+      optimizer, ', '.join(sorted(optimizer_slots))))
+  buffers = {}
+  for table in tables:
+    buffers[table] = multiprocessing.RawArray('f', vocabulary_size * embedding_size)
+    for slot in optimizer_slots[optimizer]:
+      size = vocabulary_size if slot == 'accumulator' else vocabulary_size * embedding_size
+      buffers[table + '/' + slot] = multiprocessing.RawArray('f', size)
+  arrays = shared_arrays(buffers, vocabulary_size, embedding_size)
+  # word2vec's initialization: small random embeddings, zero output weights.
+  # Drawn in blocks of rows, to not need a float64 copy of the whole table.
+  random_state = np.random.RandomState(seed)
+  for start in range(0, vocabulary_size, 65536):
+    rows = arrays['embeddings'][start:start + 65536]
+    rows[:] = random_state.uniform(-0.5, 0.5, rows.shape) / embedding_size
+  for table in tables:
+    if 'accumulator' in optimizer_slots[optimizer]:
+      arrays[table + '/accumulator'][:] = initial_accumulator
+  return buffers
+
+
+def shared_arrays(buffers, vocabulary_size, embedding_size):
+  arrays = {}
+  for name, buffer in buffers.items():
+    array = np.frombuffer(buffer, dtype=np.float32)
+    arrays[name] = array if name.endswith('/accumulator') else array.reshape(
+      (vocabulary_size, embedding_size))
+  return arrays
+
+
+def init_worker(buffers, vocabulary_size, embedding_size, data, keep, negative_table,
+                settings):
+  global shared
+  shared = dict(settings)
+  shared.update(shared_arrays(buffers, vocabulary_size, embedding_size))
+  shared['data'] = data
+  shared['keep'] = keep
+  shared['negative_table'] = negative_table
+  shared['step'] = 0
+
+
+def examples(tokens, model, window, random_state):
+  """Training examples of a run of tokens, as (inputs, mask, labels): the
+  input words of each example, which of them are real (CBOW windows are cut
+  by the dynamic window and the ends of the run), and the word to predict.
+
+  As in word2vec, the window of every position is shrunk to a random size
+  between 1 and window. For skip-gram, each context word predicts the center
+  word, which is what the word2vec code does too.
+  """
+  offsets = np.r_[-window:0, 1:window + 1]
+  positions = np.arange(len(tokens))[:, None] + offsets
+  sizes = random_state.randint(1, window + 1, size=(len(tokens), 1))
+  mask = (np.abs(offsets) <= sizes) & (positions >= 0) & (positions < len(tokens))
+  context = tokens[np.clip(positions, 0, len(tokens) - 1)]
+  if model == 'cbow':
+    rows = mask.any(axis=1)
+    return context[rows], mask[rows], tokens[rows]
+  inputs = context[mask]
+  labels = np.broadcast_to(tokens[:, None], mask.shape)[mask]
+  return inputs[:, None], np.ones((len(inputs), 1), dtype=bool), labels
+
+
+def sum_rows(rows, values):
+  """The distinct rows, and the sum of the values of each. Values are summed
+  per row after a sort, which is faster than np.add.at on rows of a table."""
+  order = np.argsort(rows, kind='stable')
+  rows = rows[order]
+  starts = np.r_[0, np.nonzero(rows[1:] != rows[:-1])[0] + 1]
+  return rows[starts], np.add.reduceat(values[order], starts, axis=0)
+
+
+def apply_update(name, rows, values, learning_rate):
+  """Move rows of the shared table name along values, the negative gradient,
+  with the optimizer of the run. Only the touched rows of the table and of
+  its optimizer slots are read or written, so the cost of a step doesn't
+  depend on the vocabulary size."""
+  if len(rows) == 0:
+    return
+  rows, values = sum_rows(rows, values)
+  optimizer = shared['optimizer']
+  if optimizer == 'adagrad':
+    accumulator = shared[name + '/accumulator']
+    accumulator[rows] += np.mean(np.square(values), axis=1)
+    values = values / np.sqrt(accumulator[rows])[:, None]
+  elif optimizer == 'lazy_adam':
+    m, v = shared[name + '/m'], shared[name + '/v']
+    m[rows] = beta1 * m[rows] + (1 - beta1) * values
+    v[rows] = beta2 * v[rows] + (1 - beta2) * np.square(values)
+    step = shared['step']
+    values = (m[rows] / (1 - beta1 ** step)) / (np.sqrt(v[rows] / (1 - beta2 ** step)) + epsilon)
+  shared[name][rows] += learning_rate * values
+
+
+def train_batch(inputs, mask, labels, negatives, learning_rate):
+  """One optimizer step on a batch, updating the shared tables in place. The
+  input vector of an example is the mean of its input word embeddings, and
+  the error is propagated back to each of them, as word2vec does. Returns
+  the summed negative-sampling loss."""
+  embeddings, softmax_weights = shared['embeddings'], shared['softmax_weights']
+  shared['step'] += 1
+  weights = mask.astype(np.float32)
+  hidden = np.einsum('bc,bce->be', weights, embeddings[inputs]) / weights.sum(1, keepdims=True)
+  targets = np.concatenate([labels[:, None], negatives], axis=1)
+  outputs = softmax_weights[targets]
+  logits = np.einsum('bke,be->bk', outputs, hidden)
+  # Negatives that happen to be the label are skipped, as in word2vec.
+  valid = np.concatenate([np.ones((len(labels), 1), dtype=bool),
+                          negatives != labels[:, None]], axis=1)
+  truth = np.zeros(logits.shape, dtype=np.float32)
+  truth[:, 0] = 1.0
+  errors = (truth - 1.0 / (1.0 + np.exp(-logits))) * valid
+  loss = (np.logaddexp(0, -logits[:, 0]).sum() +
+          (np.logaddexp(0, logits[:, 1:]) * valid[:, 1:]).sum())
+  hidden_errors = np.einsum('bk,bke->be', errors, outputs)
+  # Sparse updates of the touched rows only. Rows repeated within the batch
+  # add up; rows also updated by other workers race harmlessly (Hogwild).
+  apply_update('softmax_weights', targets.reshape(-1),
+               (errors[:, :, None] * hidden[:, None, :]).reshape((-1, hidden.shape[1])),
+               learning_rate)
+  apply_update('embeddings', inputs[mask],
+               np.broadcast_to(hidden_errors[:, None, :], mask.shape + hidden.shape[1:])[mask],
+               learning_rate)
+  return loss
+
+
+def train_shard(args):
+  """Train on tokens [start, end) of the shared id stream, for epochs passes.
+  Returns the number of tokens read, examples trained on and their loss."""
+  worker, start, end = args
+  random_state = np.random.RandomState(shared['seed'] + worker)
+  data, keep, epochs = shared['data'], shared['keep'], shared['epochs']
+  chunk_size, batch_size = shared['chunk_size'], shared['batch_size']
+  start_rate = shared['learning_rate']
+  num_tokens, num_examples, total_loss = 0, 0, 0.0
+  for epoch in range(epochs):
+    for chunk_start in range(start, end, chunk_size):
+      tokens = np.asarray(data[chunk_start:min(chunk_start + chunk_size, end)])
+      # Linear decay over the whole run, as in word2vec.
+      progress = float(epoch * (end - start) + chunk_start - start) / (epochs * (end - start))
+      learning_rate = start_rate * max(1.0 - progress, 1e-4)
+      num_tokens += len(tokens)
+      if keep is not None:
+        tokens = tokens[random_state.random_sample(len(tokens)) < keep[tokens]]
+      inputs, mask, labels = examples(tokens, shared['model'], shared['window'], random_state)
+      negatives = shared['negative_table'].sample((len(labels), shared['negative']),
+                                                  random_state)
+      for i in range(0, len(labels), batch_size):
+        total_loss += train_batch(inputs[i:i + batch_size], mask[i:i + batch_size],
+                                  labels[i:i + batch_size], negatives[i:i + batch_size],
+                                  learning_rate)
+      num_examples += len(labels)
+  return num_tokens, num_examples, total_loss
+
+
+def train(data, counts, model='cbow', embedding_size=128, window=5, negative=5,
+          optimizer='sgd', learning_rate=None, epochs=1, subsample_threshold=1e-3,
+          batch_size=128, num_workers=None, chunk_size=100000, seed=0):
+  """Train word embeddings on data, an int32 id stream (an array or a memmap),
+  with counts the count of every id. Returns the embeddings and the output
+  (softmax) weights.
+
+  The stream is cut into one shard per worker process. Workers share the
+  tables and the optimizer slots, and update them without locking: each
+  update only touches a few rows, so they rarely collide, and a lost update
+  now and then doesn't hurt SGD. optimizer is 'sgd', as word2vec, or the
+  sparse 'adagrad' (row-wise) or 'lazy_adam'. learning_rate defaults to
+  default_learning_rates, halved for skip-gram as in word2vec.
+  """
+  if model not in ('cbow', 'skipgram'):
+    raise Exception('Unknown model %s, expected cbow or skipgram.' % model)
+  num_workers = num_workers or multiprocessing.cpu_count()
+  vocabulary_size = len(counts)
+  buffers = create_buffers(vocabulary_size, embedding_size, optimizer, seed)
+  if learning_rate is None:
+    learning_rate = default_learning_rates[optimizer] / (1 if model == 'cbow' else 2)
+  keep = None
+  if subsample_threshold:
+    keep = sampling.keep_probabilities(counts, subsample_threshold)
+  settings = {'model': model, 'window': window, 'negative': negative,
+              'optimizer': optimizer, 'learning_rate': learning_rate, 'epochs': epochs,
+              'batch_size': batch_size, 'chunk_size': chunk_size, 'seed': seed}
+  bounds = [len(data) * i // num_workers for i in range(num_workers + 1)]
+  shards = [(i, bounds[i], bounds[i + 1]) for i in range(num_workers)]
+
+  print('Training %s on %d tokens with %d processes.' % (model, len(data) * epochs, num_workers))
+  start_time = time.time()
+  pool = multiprocessing.Pool(num_workers, init_worker, (
+    buffers, vocabulary_size, embedding_size, data, keep, sampling.unigram_table(counts),
+    settings))
+  try:
+    results = pool.map(train_shard, shards)
+  finally:
+    pool.close()
+    pool.join()
+  elapsed = time.time() - start_time
+  num_tokens, num_examples, total_loss = [sum(r) for r in zip(*results)]
+  print('%d tokens, %d examples in %.1fs: %.0f tokens/sec, average loss %f' % (
+    num_tokens, num_examples, elapsed, num_tokens / elapsed,
+    total_loss / max(num_examples, 1)))
+  arrays = shared_arrays(buffers, vocabulary_size, embedding_size)
+  return arrays['embeddings'].copy(), arrays['softmax_weights'].copy()
+
+
+def normalize(embeddings):
+  """Unit-length rows, for cosine similarities."""
+  return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)